@@ -0,0 +1,527 @@
+import functools
+import importlib.util
+import os
+import time
+
+import numpy as np
+import pywt
+import scipy.stats
+from scipy.io import loadmat
+from scipy.stats import entropy
+from sklearn.preprocessing import normalize
+
+from functions_dataset import find_trials, trial_window, epoch_trials, load_subjects, extract_wt, extract_psd, \
+    extract_statistical_characteristics, fit_fbcsp
+from functions_covariance import trial_covariances
+from functions_incremental import incremental_extractor
+from functions_cache import unwrap_extractor
+from lazy_dataset import TrialDataset
+from online_features import OnlineExtractor
+from functions_montage import near_channels_2a
+
+
+def timing(function, *args, repeat=5, **kwargs):
+    """
+    Function to measure the execution time of a function (best of several runs)
+
+    :param function: function to be measured
+    :param args: positional arguments of the function
+    :param repeat: number of runs
+    :param kwargs: keyword arguments of the function
+    :return: best execution time (in seconds) and result of the last run
+    """
+
+    best = np.inf
+    result = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def load_recording(data_dir, subject, n_channels=22, seed=0):
+    """
+    Function to load the continuous signal and the event matrix of a subject. If the signal has not been extracted
+    with dataloading.m, a random signal of the right length is generated (useful only for timing purposes)
+
+    :param data_dir: directory where data are saved
+    :param subject: index of the subject
+    :param n_channels: number of channels of the random signal
+    :param seed: seed of the random signal
+    :return: continuous signal (n.samples x n.channels) and event matrix
+    """
+
+    path_data = data_dir + '/S' + str(subject) + '_data.mat'
+    event_matrix = loadmat(data_dir + '/S' + str(subject) + '_label.mat')['event_matrix']
+
+    if os.path.exists(path_data):
+        data = loadmat(path_data)['data']
+    else:
+        rng = np.random.default_rng(seed)
+        data = np.asfortranarray(rng.standard_normal((event_matrix[:, 0].max() + 2000, n_channels)))
+
+    return data, event_matrix
+
+
+def loop_epoching(data, event_matrix, fs=250, start_second=2, signal_length=4, consider_artefacts=True,
+                  channel_elaboration='car'):
+    # Trial-by-trial epoching, as originally implemented inside load_dataset (reference for the benchmark)
+
+    event_position = event_matrix[:, 0]
+    event_type = event_matrix[:, 1]
+
+    positions = []
+    start_types = [768, 1023 if consider_artefacts is True else None]
+
+    for l in range(len(event_type)):
+        if event_type[l] in start_types and event_type[l + 1] in [769, 770]:
+            positions.append(l)
+
+    event_start = event_position[positions]
+
+    end_second = start_second + signal_length
+    windows_sample = np.linspace(int(start_second * fs), int(end_second * fs) - 1,
+                                 int(end_second * fs) - int(start_second * fs)).astype(int)
+
+    trials = np.zeros((len(event_start), data.shape[1], len(windows_sample)))
+    data = data.T
+
+    for j in range(trials.shape[0]):
+        d = data[:, event_start[j] + windows_sample]
+
+        if channel_elaboration == 'car':
+            d_elab = d - np.mean(d, axis=0)
+        elif channel_elaboration == 'laplacian':
+            d_elab = []
+            for channel, near_channel in near_channels_2a.items():
+                y = 0
+                for n in near_channel:
+                    y += d[n - 1]
+                d_elab.append(d[channel - 1] - y / len(near_channel))
+            d_elab = np.array(d_elab)
+        else:
+            d_elab = d
+
+        trials[j, :, :] = normalize(d_elab, axis=1)
+
+    return trials
+
+
+def vectorized_epoching(data, event_matrix, fs=250, start_second=2, signal_length=4, consider_artefacts=True,
+                        channel_elaboration='car'):
+    # Epoching as implemented in load_dataset
+
+    event_start, _ = find_trials(event_matrix, consider_artefacts)
+
+    return epoch_trials(data, event_start, trial_window(fs, start_second, signal_length), channel_elaboration)
+
+
+def benchmark_epoching(data_dir, subjects=range(1, 10), repeat=5):
+    """
+    Compare the trial-by-trial epoching with the vectorized one used by load_dataset
+
+    :param data_dir: directory where data are saved
+    :param subjects: subjects to be considered
+    :param repeat: number of runs for each measure
+    """
+
+    print("\nEpoching benchmark:\n")
+
+    for channel_elaboration in ['car', 'laplacian', None]:
+        time_loop, time_vectorized = 0, 0
+
+        for subject in subjects:
+            data, event_matrix = load_recording(data_dir, subject)
+
+            t, reference = timing(loop_epoching, data, event_matrix, repeat=repeat,
+                                  channel_elaboration=channel_elaboration)
+            time_loop += t
+            t, trials = timing(vectorized_epoching, data, event_matrix, repeat=repeat,
+                               channel_elaboration=channel_elaboration)
+            time_vectorized += t
+
+            assert np.allclose(reference, trials)
+
+        print("\t{}: loop {:.4f} s, vectorized {:.4f} s (x{:.1f})".format(channel_elaboration, time_loop,
+                                                                          time_vectorized,
+                                                                          time_loop / time_vectorized))
+
+
+def loop_wt(matrix):
+    # Trial-by-trial and channel-by-channel wavelet decomposition, as originally implemented in extract_wt (reference
+    # for the benchmark)
+
+    approx_trials = []
+
+    for trial in matrix:
+        approx = []
+
+        for channel in trial:
+            ca, _ = pywt.dwt(channel, 'sym9')
+            approx.append(ca)
+
+        approx_trials.append(approx)
+
+    return np.array(approx_trials)
+
+
+def benchmark_wt(data_dir, subjects=range(1, 10), repeat=5):
+    """
+    Compare the channel-by-channel wavelet decomposition with the batched one of extract_wt
+
+    :param data_dir: directory where data are saved
+    :param subjects: subjects to be considered
+    :param repeat: number of runs for each measure
+    """
+
+    print("\nWavelet benchmark:\n")
+
+    time_loop, time_batched = 0, 0
+
+    for subject in subjects:
+        trials = vectorized_epoching(*load_recording(data_dir, subject))
+
+        t, reference = timing(loop_wt, trials, repeat=repeat)
+        time_loop += t
+        t, approx = timing(extract_wt, trials, repeat=repeat)
+        time_batched += t
+
+        assert np.allclose(reference, approx)
+
+    print("\tsym9: loop {:.4f} s, batched {:.4f} s (x{:.1f})".format(time_loop, time_batched, time_loop / time_batched))
+
+
+def loop_statistical_characteristics(matrix):
+    # Trial-by-trial and channel-by-channel statistical characteristics, as originally implemented in
+    # extract_statistical_characteristics (reference for the benchmark)
+
+    sc_dataset = np.zeros((matrix.shape[0], matrix.shape[1], matrix.shape[1] + 10), dtype=matrix.dtype)
+
+    for t, trial in enumerate(matrix):
+        trial = np.matrix(trial)
+
+        for i in range(trial.shape[0]):
+            data = trial[i, :]
+            sc = scipy.stats.describe(data, axis=1)
+            sc_dataset[t, i, 0] = sc.mean[0]
+            sc_dataset[t, i, 1] = np.mean(np.square(data))
+            sc_dataset[t, i, 2] = sc.variance[0]
+            sc_dataset[t, i, 3] = sc.skewness[0]
+            sc_dataset[t, i, 4] = sc.kurtosis[0]
+            sc_dataset[t, i, 5] = entropy(data, axis=1)[0]
+            sc_dataset[t, i, 6] = np.trapz(np.array(data), axis=1)[0]
+            sc_dataset[t, i, 7] = len(data) - np.count_nonzero(data)
+            sc_dataset[t, i, 8] = np.max(data) - np.min(data)
+            sc_dataset[t, i, 9] = 0
+
+        sc_dataset[t, :, 10:] = np.corrcoef(trial)
+
+    return np.nan_to_num(sc_dataset, neginf=-5)
+
+
+def benchmark_statistical_characteristics(data_dir, subjects=range(1, 10), repeat=5):
+    """
+    Compare the channel-by-channel statistical characteristics with the vectorized ones of
+    extract_statistical_characteristics (the results must be identical)
+
+    :param data_dir: directory where data are saved
+    :param subjects: subjects to be considered
+    :param repeat: number of runs for each measure
+    """
+
+    print("\nStatistical characteristics benchmark:\n")
+
+    time_loop, time_vectorized = 0, 0
+
+    for subject in subjects:
+        trials = vectorized_epoching(*load_recording(data_dir, subject))
+
+        t, reference = timing(loop_statistical_characteristics, trials, repeat=repeat)
+        time_loop += t
+        t, sc = timing(extract_statistical_characteristics, trials, repeat=repeat)
+        time_vectorized += t
+
+        assert np.array_equal(reference, sc)
+
+    print("\tloop {:.4f} s, vectorized {:.4f} s (x{:.1f})".format(time_loop, time_vectorized,
+                                                               time_loop / time_vectorized))
+
+
+def loop_covariances(trials):
+    # Trial-by-trial covariance, as originally implemented in FBCSP_V4.trialCovariance (reference for the benchmark)
+
+    covariance_matrix = np.zeros((trials.shape[0], trials.shape[1], trials.shape[1]))
+
+    for i in range(trials.shape[0]):
+        covariance_matrix[i, :, :] = np.cov(trials[i, :, :])
+
+    return covariance_matrix
+
+
+def benchmark_covariance(data_dir, subjects=range(1, 10), repeat=5):
+    """
+    Compare the np.cov loop with trial_covariances (same results), on the trials of all the subjects together (as in
+    the training of FBCSP_V4) and with the shrinkage estimators
+
+    :param data_dir: directory where data are saved
+    :param subjects: subjects to be considered
+    :param repeat: number of runs for each measure
+    """
+
+    print("\nCovariance benchmark:\n")
+
+    trials = np.concatenate([vectorized_epoching(*load_recording(data_dir, subject)) for subject in subjects])
+
+    time_loop, reference = timing(loop_covariances, trials, repeat=repeat)
+    time_covariances, covariances = timing(trial_covariances, trials, repeat=repeat)
+
+    assert np.array_equal(reference, covariances)
+
+    print("\t{} trials: np.cov {:.4f} s, trial_covariances {:.4f} s (x{:.1f})".format(len(trials), time_loop,
+                                                                                      time_covariances,
+                                                                                      time_loop / time_covariances))
+
+    for shrinkage in ['ledoit_wolf', 'oas']:
+        t, _ = timing(trial_covariances, trials, shrinkage, repeat=repeat)
+        print("\t{}: trial_covariances {:.4f} s".format(shrinkage, t))
+
+
+def benchmark_online(data_dir, subject=1, fs=250, hop_seconds=0.2, packet=10, seconds=300, seed=0):
+    """
+    Replay the continuous recording of a subject through the online feature extraction, packet by packet, and compare
+    the elaboration time with the duration of the recording (the extraction must be faster than real time). For the
+    CSP features, random spatial filters are used (useful only for timing purposes)
+
+    :param data_dir: directory where data are saved
+    :param subject: index of the subject
+    :param fs: sampling frequency of the signal
+    :param hop_seconds: interval between two consecutive windows
+    :param packet: number of samples received at a time
+    :param seconds: length of the replayed part of the recording
+    :param seed: seed of the random spatial filters
+    """
+
+    print("\nOnline extraction benchmark (hop {} s, packets of {} samples):\n".format(hop_seconds, packet))
+
+    data, _ = load_recording(data_dir, subject)
+    data = data[:int(seconds * fs)]
+
+    rng = np.random.default_rng(seed)
+    bands = [(f, f + 4) for f in range(4, 40, 4)]
+    csp_filters = [rng.standard_normal((data.shape[1], data.shape[1])) for _ in bands]
+
+    for features in ['wavelet', 'csp']:
+        extractor = OnlineExtractor(data.shape[1], fs, hop_seconds=hop_seconds, features=features, bands=bands,
+                                    csp_filters=csp_filters)
+
+        n_windows = 0
+        start = time.perf_counter()
+        for i in range(0, len(data), packet):
+            n_windows += len(extractor.push(data[i:i + packet]))
+        elapsed = time.perf_counter() - start
+
+        print("\t{}: {} windows in {:.2f} s for {:.0f} s of signal (x{:.0f} real time, {:.2f} ms per hop)".format(
+            features, n_windows, elapsed, len(data) / fs, len(data) / fs / elapsed, 1000 * elapsed / n_windows))
+
+
+def check_fbcsp_channels(fbcsp, trials, channels=range(22), seed=0):
+    """
+    Check that the FBCSP features of the channel ablation and permutation computed from the band covariances (as in
+    ablation_zero_channels and permutation_channels with fbcsp) are equal to the ones of extractFeatures applied to the
+    perturbed trials
+
+    :param fbcsp: trained FBCSP_V4 object
+    :param trials: trials to be perturbed (n.trials x n.channels x n.samples)
+    :param channels: channels to be checked
+    :param seed: seed of the random permutation of the trials
+    """
+
+    print("\nFBCSP channel perturbations check:\n")
+
+    trials = np.asarray(trials)
+    rng = np.random.default_rng(seed)
+    fbcsp.cacheTrials(trials)
+
+    difference_ablation, difference_permutation = 0, 0
+
+    for k in channels:
+        perturbed = trials.copy()
+        perturbed[:, k, :] = 0
+        difference_ablation = max(difference_ablation, np.max(np.abs(fbcsp.channelAblationFeatures(k) -
+                                                                     fbcsp.extractFeatures(perturbed))))
+
+        donors = rng.permutation(len(trials))
+        perturbed = trials.copy()
+        perturbed[:, k, :] = trials[donors, k, :]
+        difference_permutation = max(difference_permutation,
+                                     np.max(np.abs(fbcsp.channelPermutationFeatures(k, donors) -
+                                                   fbcsp.extractFeatures(perturbed))))
+
+    print("\tmaximum difference of the features: ablation {:.2e}, permutation {:.2e}".format(difference_ablation,
+                                                                                            difference_permutation))
+
+    assert difference_ablation < 1e-8 and difference_permutation < 1e-8
+
+
+def check_incremental_extractors(trials, functions, n_segments=20, seed=0, tolerance=1e-8):
+    """
+    Check that the features of the perturbed trials computed by the incremental extractors (as in the segment
+    ablation and permutation of functions_network) are equal to the ones of the feature extraction functions applied
+    to the perturbed trials. Random segments of the signals are set to zero, together with the first and last sample
+    and the whole signals. The functions without an incremental version are skipped
+
+    :param trials: trials to be perturbed (n.trials x n.channels x n.samples)
+    :param functions: feature extraction functions to be checked (also functools.partial objects)
+    :param n_segments: number of random segments checked for each function
+    :param seed: seed of the random segments
+    :param tolerance: maximum difference of the features
+    """
+
+    print("\nIncremental extractors check ({} samples):\n".format(np.shape(trials)[-1]))
+
+    trials = np.asarray(trials)
+    n_samples = trials.shape[-1]
+    rng = np.random.default_rng(seed)
+
+    for function_features in functions:
+        function, keywords = unwrap_extractor(function_features)
+        name = '{}({})'.format(function.__name__, ', '.join('{}={!r}'.format(*item) for item in (keywords or {}).items()))
+        incremental = incremental_extractor(trials, function_features)
+
+        if incremental is None:
+            print("\t{}: full extraction".format(name))
+            continue
+
+        starts = rng.integers(0, n_samples, n_segments)
+        ends = starts + rng.integers(1, n_samples // 4, n_segments)
+        segments = [(0, 1), (n_samples - 1, n_samples), (0, n_samples)] + \
+                   [(start, min(end, n_samples)) for start, end in zip(starts, ends)]
+
+        difference = 0
+
+        for start, end in segments:
+            perturbed = trials.copy()
+            perturbed[..., start:end] = 0
+            difference = max(difference, np.max(np.abs(incremental(perturbed, start, end) -
+                                                       function_features(perturbed))))
+
+        print("\t{}: maximum difference of the features {:.2e}".format(name, difference))
+
+        assert difference < tolerance
+
+
+def check_feature_layers(trials, functions, tolerance=1e-10):
+    """
+    Check that the preprocessing layers built by feature_layer (in float64) compute the same features of the feature
+    extraction functions. Needs tensorflow
+
+    :param trials: trials (n.trials x n.channels x n.samples)
+    :param functions: feature extraction functions with a preprocessing layer (also functools.partial objects)
+    :param tolerance: maximum difference of the features, relative to their maximum value
+    """
+
+    import tensorflow as tf
+    from functions_layers import feature_layer
+
+    print("\nPreprocessing layers check ({} samples):\n".format(np.shape(trials)[-1]))
+
+    trials = np.asarray(trials, dtype=np.float64)
+
+    for function_features in functions:
+        function, keywords = unwrap_extractor(function_features)
+        name = '{}({})'.format(function.__name__, ', '.join('{}={!r}'.format(*item) for item in keywords.items()))
+
+        reference = function_features(trials)
+        features = feature_layer(function_features, dtype='float64')(tf.constant(trials)).numpy()
+
+        difference = np.max(np.abs(features - reference)) / np.max(np.abs(reference))
+        print("\t{}: maximum relative difference of the features {:.2e}".format(name, difference))
+
+        assert features.shape == reference.shape and difference < tolerance
+
+
+def check_precision(data_dir, cache_dir, subjects=range(1, 10), dtype=np.float32, storage_dtype=np.float16,
+                    model_path=None, function_features=extract_wt, necessary_redimension=True, tolerance=0.01):
+    """
+    Check that the reduced precision pipeline gives the same results of the float64 one: the differences of trials and
+    features are printed and, if a trained model is given, the difference of accuracy must be within the tolerance
+
+    :param data_dir: directory where data are saved
+    :param cache_dir: directory of the trials cache
+    :param subjects: subjects to be considered
+    :param dtype: data type of the reduced precision pipeline
+    :param storage_dtype: data type of the trials saved in the cache
+    :param model_path: path of a trained model (None to skip the accuracy check)
+    :param function_features: function for the feature extraction (None to use the signal)
+    :param necessary_redimension: boolean to indicate if redimension is necessary
+    :param tolerance: maximum difference of accuracy
+    """
+
+    print("\nPrecision check ({}, stored as {}):\n".format(np.dtype(dtype).name, np.dtype(storage_dtype).name))
+
+    reference, labels = load_subjects(data_dir, subjects, n_jobs=1)
+    reduced, _ = TrialDataset.from_cache(data_dir, subjects, cache_dir, dtype=dtype,
+                                         storage_dtype=storage_dtype).to_array()
+
+    print("\tmaximum difference of the trials: {:.2e}".format(np.max(np.abs(reference - reduced))))
+    print("\tmemory of the trials: {:.1f} MB -> {:.1f} MB".format(reference.nbytes / 2 ** 20, reduced.nbytes / 2 ** 20))
+
+    if function_features is not None:
+        reference = function_features(reference)
+        reduced = function_features(reduced)
+        print("\tmaximum difference of the features: {:.2e}".format(np.max(np.abs(reference - reduced))))
+
+    if model_path is not None:
+        import tensorflow as tf
+
+        model = tf.keras.models.load_model(model_path)
+
+        if necessary_redimension:
+            reference = np.expand_dims(reference, 3)
+            reduced = np.expand_dims(reduced, 3)
+
+        accuracy_reference = model.evaluate(reference, labels, verbose=0)[1]
+        accuracy_reduced = model.evaluate(reduced, labels, verbose=0)[1]
+        print("\taccuracy: float64 {:.4f}, {} {:.4f}".format(accuracy_reference, np.dtype(dtype).name,
+                                                               accuracy_reduced))
+
+        assert abs(accuracy_reference - accuracy_reduced) <= tolerance
+
+
+if __name__ == "__main__":
+
+    data_folder = '../dataset/EEG'
+    cache_folder = '../dataset/cache'
+
+    benchmark_epoching(data_folder)
+    benchmark_wt(data_folder)
+    benchmark_statistical_characteristics(data_folder)
+    benchmark_covariance(data_folder)
+    benchmark_online(data_folder)
+
+    # The preprocessing layers are checked only where tensorflow is installed
+    if importlib.util.find_spec('tensorflow') is not None:
+        signals = np.random.default_rng(0).standard_normal((16, 22, 1000))
+        layer_functions = [extract_wt, functools.partial(extract_wt, wavelet='db4'), extract_psd,
+                           functools.partial(extract_psd, nperseg=128, noverlap=96)]
+        check_feature_layers(signals, layer_functions)
+        check_feature_layers(signals[..., :-1], layer_functions)
+
+    # The following checks need the signals extracted with dataloading.m
+    if os.path.exists(data_folder + '/S1_data.mat'):
+        model = '../models/model.h5'
+        check_precision(data_folder, cache_folder, model_path=model if os.path.exists(model) else None)
+
+        trials, labels = load_subjects(data_folder, [1], n_jobs=1)
+        check_fbcsp_channels(fit_fbcsp(trials, labels, n_features=396), trials)
+
+        # Signals of even and odd length, for all the extension modes of the wavelet decomposition
+
+        wavelet_functions = [functools.partial(extract_wt, wavelet=wavelet, mode=mode)
+                             for wavelet in ['haar', 'db4', 'sym9'] for mode in pywt.Modes.modes]
+        check_incremental_extractors(trials, wavelet_functions)
+        check_incremental_extractors(trials[..., :-1], wavelet_functions)
+        check_incremental_extractors(trials, [extract_statistical_characteristics])
@@ -0,0 +1,26 @@
+from functions_dataset import build_trial_index
+from functions_store import read_gdf, write_store_subject
+
+if __name__ == "__main__":
+
+    # Python version of utilities/dataloading.m: the GDF files of the 2a dataset (BCI competition) are read from
+    # dataset_folder and the data of all the subjects are saved in a single HDF5 store, to be used as data_dir
+
+    dataset_folder = '../dataset'
+    store_path = '../dataset/EEG/dataset.h5'
+
+    subjects = range(1, 10, 1)
+    fs = 250                # sampling frequency
+    trial_seconds = 7       # length of the raw trials saved in the store
+
+    for subject in subjects:
+        print("Subject {}...".format(subject))
+
+        data, event_matrix = read_gdf(dataset_folder + '/A0{}T.gdf'.format(subject))
+
+        index = build_trial_index(event_matrix, subject, consider_artefacts=True)
+
+        write_store_subject(store_path, subject, data, event_matrix, index.sample, index.label + 769, index.artefact,
+                            fs=fs, trial_seconds=trial_seconds)
+
+    print("\t- Successfully saved in {}".format(store_path))
@@ -0,0 +1,340 @@
+import functools
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+
+def file_signature(path):
+    """
+    Function to describe the current version of a file on disk, used to invalidate the cached data derived from it
+
+    :param path: path of the file
+    :return: dictionary with absolute path, size and last modification time of the file
+    """
+
+    stat = os.stat(path)
+
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def cache_key(**params):
+    """
+    Function to build a stable key from a set of parameters (the order of the parameters is not relevant)
+
+    :param params: parameters that identify the cached data
+    :return: hexadecimal string identifying the parameters
+    """
+
+    encoded = json.dumps(params, sort_keys=True, default=str).encode()
+
+    return hashlib.sha1(encoded).hexdigest()[:20]
+
+
+def atomic_save(path, array):
+    """
+    Function to save an array in .npy format: it is written in a temporary file of the same folder and then moved to
+    its final name, so that concurrent jobs never see a partially written file
+
+    :param path: destination path of the array
+    :param array: array to be saved
+    """
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.ascontiguousarray(array))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_cached_arrays(cache_dir, key, names, sources=()):
+    """
+    Function to load the arrays saved in the cache with the given key as read-only memory maps
+
+    :param cache_dir: directory of the cache
+    :param key: key of the cached entry (see cache_key)
+    :param names: names of the arrays to be loaded
+    :param sources: files from which the arrays were derived: if one of them changed, the entry is not valid anymore
+    :return: dictionary {name: array} if the entry exists and is valid, None otherwise
+    """
+
+    meta_path = os.path.join(cache_dir, key + '.json')
+
+    if not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    # Check that the source files did not change after the creation of the entry
+
+    if meta.get('sources') != [file_signature(source) for source in sources]:
+        return None
+
+    arrays = {}
+    for name in names:
+        path = os.path.join(cache_dir, '{}.{}.npy'.format(key, name))
+        if not os.path.exists(path):
+            return None
+        arrays[name] = np.load(path, mmap_mode='r')
+
+    return arrays
+
+
+def save_cached_arrays(cache_dir, key, arrays, sources=(), params=None):
+    """
+    Function to save a set of arrays in the cache with the given key
+
+    :param cache_dir: directory of the cache
+    :param key: key of the entry (see cache_key)
+    :param arrays: dictionary {name: array} of the arrays to be saved
+    :param sources: files from which the arrays are derived, checked when the entry is loaded
+    :param params: parameters that generated the entry, saved for reference
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    for name, array in arrays.items():
+        atomic_save(os.path.join(cache_dir, '{}.{}.npy'.format(key, name)), array)
+
+    # The metadata file is written as last one: an entry is considered valid only when it exists
+
+    meta = {'sources': [file_signature(source) for source in sources], 'params': params,
+            'arrays': {name: {'shape': list(np.shape(array)), 'dtype': str(np.asarray(array).dtype)}
+                       for name, array in arrays.items()}}
+
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(meta, f, indent=2, default=str)
+    os.replace(tmp_path, os.path.join(cache_dir, key + '.json'))
+
+
+def content_hash(*args, **kwargs):
+    """
+    Function to build a key from the content of a set of arguments: arrays are identified by their data type, shape and
+    values, the other arguments by their representation
+
+    :param args: positional arguments
+    :param kwargs: keyword arguments (the order is not relevant)
+    :return: hexadecimal string identifying the arguments
+    """
+
+    hasher = hashlib.sha1()
+
+    for name, value in [(None, arg) for arg in args] + sorted(kwargs.items()):
+        hasher.update(repr(name).encode())
+
+        if isinstance(value, np.ndarray):
+            hasher.update('{}{}'.format(value.dtype.str, value.shape).encode())
+            hasher.update(np.ascontiguousarray(value).data)
+        else:
+            hasher.update(repr(value).encode())
+
+    return hasher.hexdigest()
+
+
+def unwrap_extractor(function_features):
+    """
+    :param function_features: feature extraction function, possibly a functools.partial or wrapped by a decorator (e.g.
+    FeatureCache.wrap)
+    :return: original function and keyword arguments fixed by the partials (None if positional arguments are fixed)
+    """
+
+    keywords = {}
+
+    while True:
+        if isinstance(function_features, functools.partial):
+            if function_features.args:
+                return function_features.func, None
+
+            # Keywords of the outer partials override the ones of the inner partials
+
+            keywords = {**function_features.keywords, **keywords}
+            function_features = function_features.func
+
+        elif hasattr(function_features, '__wrapped__'):
+            function_features = function_features.__wrapped__
+
+        else:
+            return function_features, keywords
+
+
+def function_key(function_features):
+    """
+    Function to build a key identifying a feature extraction function: module and qualified name of the original
+    function, keyword arguments fixed by the partials and current version of the file of the module (so that the
+    results computed by a previous version of the code are not reused)
+
+    :param function_features: feature extraction function defined at the top level of a module (also a
+    functools.partial fixing its keyword arguments)
+    :return: string identifying the function
+    """
+
+    function, keywords = unwrap_extractor(function_features)
+
+    # Lambdas, nested functions and partials with positional arguments cannot be told apart by their name
+
+    qualname = getattr(function, '__qualname__', None)
+    module = sys.modules.get(getattr(function, '__module__', None))
+
+    if keywords is None or qualname is None or '<' in qualname or getattr(module, '__file__', None) is None:
+        raise ValueError('The function cannot be identified: {!r}'.format(function_features))
+
+    version = cache_key(module=module.__name__, qualname=qualname, keywords=content_hash(**keywords),
+                        source=file_signature(module.__file__))
+
+    return '{}.{}'.format(qualname, version)
+
+
+class FeatureCache:
+    """
+    Cache of the results of the feature extraction functions, identified by the function (see function_key) and by the
+    content of its arguments. Results are kept in memory (the least recently used ones are discarded when the byte budget is
+    exceeded) and, if a directory is given, also on disk to be reused by the following runs
+    """
+
+    def __init__(self, max_bytes=2 ** 30, cache_dir=None):
+        """
+        :param max_bytes: maximum size (in bytes) of the results kept in memory
+        :param cache_dir: directory of the results saved on disk (None to keep them only in memory)
+        """
+
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __call__(self, function, *args, **kwargs):
+        """
+        :param function: feature extraction function, defined at the top level of a module (also a functools.partial
+        fixing its keyword arguments)
+        :param args: positional arguments of the function
+        :param kwargs: keyword arguments of the function
+        :return: result of the function (read-only array), computed only if it is not in the cache
+        """
+
+        key = '{}.{}'.format(function_key(function), content_hash(*args, **kwargs))
+
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        path = None if self.cache_dir is None else os.path.join(self.cache_dir, key + '.npy')
+
+        if path is not None and os.path.exists(path):
+            self.disk_hits += 1
+            result = np.load(path)
+        else:
+            self.misses += 1
+            result = np.asarray(function(*args, **kwargs))
+            if path is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                atomic_save(path, result)
+
+        # Results are shared by all the following calls: they cannot be modified
+
+        result.setflags(write=False)
+        self.store(key, result)
+
+        return result
+
+    def store(self, key, result):
+        # Save the result in memory, discarding the least recently used ones to respect the budget
+
+        if result.nbytes > self.max_bytes:
+            return
+
+        self.entries[key] = result
+        self.n_bytes += result.nbytes
+
+        while self.n_bytes > self.max_bytes:
+            _, discarded = self.entries.popitem(last=False)
+            self.n_bytes -= discarded.nbytes
+
+    def wrap(self, function):
+        """
+        :param function: feature extraction function, defined at the top level of a module (also a functools.partial
+        fixing its keyword arguments)
+        :return: function with the same name and arguments, whose results are read from the cache (the original
+        function is kept as its uncached attribute, for the data that will not be seen again)
+        """
+
+        # Functions that cannot be identified are refused immediately, not at the first call
+
+        function_key(function)
+
+        @functools.wraps(function)
+        def cached_function(*args, **kwargs):
+            return self(function, *args, **kwargs)
+
+        cached_function.uncached = function
+
+        return cached_function
+
+    def stats(self):
+        """
+        :return: dictionary with the number of hits (in memory and on disk) and misses, and the memory used
+        """
+
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'entries': len(self.entries), 'bytes': self.n_bytes}
+
+    def clear(self):
+        # Discard the results kept in memory (the ones on disk are kept)
+
+        self.entries.clear()
+        self.n_bytes = 0
+
+
+def uncached(function_features):
+    """
+    :param function_features: feature extraction function, possibly wrapped by FeatureCache.wrap
+    :return: the function without the cache (e.g. for perturbed datasets, whose features are never reused)
+    """
+
+    return getattr(function_features, 'uncached', function_features)
+
+
+def stored_features(store_dir, function_features, dataset_key, indexes, data, *args, sources=(), **params):
+    """
+    Function to retrieve the features of a subset of a dataset from the feature store, computing and saving them if
+    they are missing. Features are identified by the dataset, the indexes of the trials in the subset, the extraction
+    function and its parameters, and they are returned as read-only memory maps
+
+    :param store_dir: directory of the feature store
+    :param function_features: function for the feature extraction (see function_key)
+    :param dataset_key: key of the whole dataset (e.g. from dataset_cache_key)
+    :param indexes: indexes of the trials of the subset inside the dataset
+    :param data: trials of the subset, or function returning them (called only if the features must be computed)
+    :param args: other positional arguments of function_features (e.g. labels and number of features of extractFBCSP)
+    :param sources: files from which the dataset is derived: if one of them changes, the features are computed again
+    :param params: keyword arguments of function_features
+    :return: matrix of the features of the subset
+    """
+
+    split = hashlib.sha1(np.ascontiguousarray(indexes, dtype=np.int64).data).hexdigest()
+    provenance = {'dataset': dataset_key, 'split': split, 'n_trials': len(indexes),
+                  'extractor': function_key(function_features), 'args': content_hash(*args), 'params': params}
+    key = '{}_{}'.format(unwrap_extractor(function_features)[0].__name__, cache_key(**provenance))
+
+    cached = load_cached_arrays(store_dir, key, ['features'], sources=sources)
+
+    if cached is None:
+        trials = data() if callable(data) else data
+        save_cached_arrays(store_dir, key, {'features': function_features(trials, *args, **params)}, sources=sources,
+                           params=provenance)
+        cached = load_cached_arrays(store_dir, key, ['features'], sources=sources)
+
+    return cached['features']
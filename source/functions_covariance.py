@@ -0,0 +1,163 @@
+import numpy as np
+
+
+def trial_covariances(trials, shrinkage=None, out=None):
+    """
+    Function to compute the covariance of the channels of each trial (as np.cov, normalized by n.samples - 1, with the
+    same results). Each trial is centered and multiplied by its transpose directly in the output: a trial fits in the
+    processor cache, so this is faster than centering the whole matrix at once, which is limited by the memory bandwidth
+
+    :param trials: signals of the trials (n.trials x n.channels x n.samples)
+    :param shrinkage: None, 'ledoit_wolf', 'oas' (intensity estimated for each trial, as in sklearn.covariance) or a
+    fixed intensity in [0, 1]: each covariance C is replaced by (1 - s) * C + s * trace(C) / n.channels * I
+    :param out: optional preallocated output (n.trials x n.channels x n.channels, float64)
+    :return: covariances of the trials (n.trials x n.channels x n.channels)
+    """
+
+    n_trials, n_channels, n_samples = np.shape(trials)
+
+    if shrinkage is not None and shrinkage not in ['ledoit_wolf', 'oas'] and \
+            not (isinstance(shrinkage, (int, float)) and 0 <= shrinkage <= 1):
+        raise ValueError('Unknown shrinkage: {}'.format(shrinkage))
+
+    if out is None:
+        out = np.empty((n_trials, n_channels, n_channels))
+
+    # Sum over the samples of the squared norm of the centered channels vector, needed by the Ledoit-Wolf estimator
+
+    fourth_moments = np.empty(n_trials)
+
+    for i in range(n_trials):
+        # Computation in float64, as np.cov
+
+        centered = np.asarray(trials[i], dtype=np.float64)
+        centered = centered - np.mean(centered, axis=1, keepdims=True)
+
+        np.dot(centered, centered.T, out=out[i])
+
+        if shrinkage == 'ledoit_wolf':
+            fourth_moments[i] = np.sum(np.square(np.sum(np.square(centered), axis=0)))
+
+    out *= np.true_divide(1, n_samples - 1)
+
+    if shrinkage is not None:
+        if shrinkage == 'ledoit_wolf':
+            intensity = ledoit_wolf_shrinkage(out, n_samples, fourth_moments)
+        elif shrinkage == 'oas':
+            intensity = oas_shrinkage(out, n_samples)
+        else:
+            intensity = np.full(n_trials, shrinkage)
+
+        out[:] = shrink(out, intensity)
+
+    return out
+
+
+def shrink(covariances, intensity):
+    """
+    :param covariances: covariances (n.trials x n.channels x n.channels)
+    :param intensity: shrinkage intensity of each covariance (n.trials)
+    :return: covariances shrunk towards the identity scaled by their average variance
+    """
+
+    n_channels = covariances.shape[-1]
+    intensity = np.asarray(intensity)[:, np.newaxis, np.newaxis]
+
+    mu = np.trace(covariances, axis1=1, axis2=2)[:, np.newaxis, np.newaxis] / n_channels
+
+    return (1 - intensity) * covariances + intensity * mu * np.eye(n_channels)
+
+
+def ledoit_wolf_shrinkage(covariances, n_samples, fourth_moments):
+    """
+    Ledoit-Wolf shrinkage intensity of each trial (as sklearn.covariance.ledoit_wolf_shrinkage, with the samples as
+    observations and the channels as features)
+
+    :param covariances: covariances of the trials, normalized by n.samples - 1
+    :param n_samples: number of samples of the trials
+    :param fourth_moments: sum over the samples of the squared norm of the centered channels vector, for each trial
+    :return: shrinkage intensities (n.trials)
+    """
+
+    n_channels = covariances.shape[-1]
+
+    # Statistics of the maximum likelihood covariance (normalized by n.samples)
+
+    covariances = covariances * ((n_samples - 1) / n_samples)
+    trace = np.trace(covariances, axis1=1, axis2=2)
+    mu = trace / n_channels
+
+    delta_ = np.sum(np.square(covariances), axis=(1, 2))
+
+    beta = (fourth_moments / n_samples - delta_) / (n_channels * n_samples)
+    delta = (delta_ - 2 * mu * trace + n_channels * mu ** 2) / n_channels
+
+    # Intensity limited to 1 (the covariance is not shrunk beyond the target)
+
+    beta = np.minimum(beta, delta)
+
+    return np.divide(beta, delta, out=np.zeros_like(beta), where=beta != 0)
+
+
+def oas_shrinkage(covariances, n_samples):
+    """
+    Oracle approximating shrinkage intensity of each trial (as sklearn.covariance.oas). The intensity does not depend
+    on the normalization of the covariances
+
+    :param covariances: covariances of the trials (n.trials x n.channels x n.channels)
+    :param n_samples: number of samples of the trials
+    :return: shrinkage intensities (n.trials)
+    """
+
+    n_channels = covariances.shape[-1]
+
+    alpha = np.mean(np.square(covariances), axis=(1, 2))
+    mu_squared = (np.trace(covariances, axis1=1, axis2=2) / n_channels) ** 2
+
+    num = alpha + mu_squared
+    den = (n_samples + 1) * (alpha - mu_squared / n_channels)
+
+    return np.minimum(np.divide(num, den, out=np.ones_like(num), where=den != 0), 1)
+
+
+def composite_covariance(class_covariances, class_counts=None):
+    """
+    Composite covariance of the classes, used for the whitening of the CSP
+
+    :param class_covariances: list of the mean covariances of the classes
+    :param class_counts: number of trials of each class. If given, the mean covariances are weighted by the number of
+    trials (i.e. the result is the mean covariance of all the trials), otherwise they are summed
+    :return: composite covariance (n.channels x n.channels)
+    """
+
+    if class_counts is None:
+        return np.sum(class_covariances, axis=0)
+
+    weights = np.asarray(class_counts, dtype=np.float64) / np.sum(class_counts)
+
+    return np.tensordot(weights, np.asarray(class_covariances), axes=1)
+
+
+def csp_filters(covariances, composite):
+    """
+    Function to compute the CSP spatial filters as solutions of the symmetric-definite generalized eigenproblem
+    C w = l R w, for several problems at once (e.g. one for each band of a filter bank). The problem is reduced to a
+    symmetric one with the Cholesky factor L of R (L^-1 C L^-T v = l v, w = L^-T v)
+
+    :param covariances: mean covariance of the first class (... x n.channels x n.channels)
+    :param composite: composite covariance of the classes (... x n.channels x n.channels, positive definite)
+    :return: spatial filters (... x n.filters x n.channels, one filter for each row, normalized as w^T R w = 1) and
+    eigenvalues (... x n.filters), both sorted by decreasing eigenvalue
+    """
+
+    L = np.linalg.cholesky(composite)
+
+    # L^-1 C L^-T, made exactly symmetric before the decomposition
+
+    reduced = np.linalg.solve(L, np.swapaxes(np.linalg.solve(L, covariances), -1, -2))
+    reduced = (reduced + np.swapaxes(reduced, -1, -2)) / 2
+
+    eigenvalues, eigenvectors = np.linalg.eigh(reduced)
+    filters = np.swapaxes(np.linalg.solve(np.swapaxes(L, -1, -2), eigenvectors), -1, -2)
+
+    return filters[..., ::-1, :], eigenvalues[..., ::-1]
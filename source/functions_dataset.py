@@ -1,127 +1,464 @@
 import copy
+import os
 from scipy.signal import medfilt
 import scipy
 import numpy as np
 import scipy
 from scipy import signal
 from scipy.stats import entropy
+from scipy.special import xlogy
 from sklearn.preprocessing import normalize, scale
-from scipy.io import loadmat
+from scipy.io import loadmat, whosmat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from collections import deque
 import pywt
 from utilities.FBCSP_V4 import *
+from functions_cache import cache_key, load_cached_arrays, save_cached_arrays
+from functions_montage import montage_matrix, apply_montage
+from functions_filter import bandpass_sos, filter_trials
+from functions_store import is_store, read_store_subject, read_store_events, store_data_shape
+from trial_index import TrialIndex
 import mne
 
 def bandpassfilter(sig, lowcut, highcut, fs, order=5):
-    # Pass band filtering for a digital signal
+    # Pass band filtering for a digital signal (along the samples of the first axis)
 
-    [b, a] = scipy.signal.butter(order, [lowcut, highcut], btype='bandpass', fs=fs, analog=False)
-    y = scipy.signal.filtfilt(b, a, sig, axis=0)
+    return filter_trials(np.asarray(sig), bandpass_sos(order, lowcut, highcut, fs), axis=0)
 
-    return np.array(y)
 
+def find_trials(event_matrix, consider_artefacts=True):
+    """
+    Function to find the trials of interest inside the event matrix of a subject (saved according to dataloading.m)
+
+    :param event_matrix: matrix of the events (position, type and duration for each event)
+    :param consider_artefacts: True if trials labeled as artefacts in the dataset are considered, False otherwise
+    :return: sample at which each trial starts and its label (769 for left hand, 770 for right hand)
+    """
+
+    event_position = event_matrix[:, 0]
+    event_type = event_matrix[:, 1]
+
+    # Find the samples at which the signal of interest starts (labeled as 768 and 1023 - if consider_artefacts =
+    # True) and followed by label 769 (left hand) or 770 (right hand)
+
+    start_types = [768, 1023] if consider_artefacts is True else [768]
+
+    is_start = np.isin(event_type[:-1], start_types) & np.isin(event_type[1:], [769, 770])
+    positions = np.flatnonzero(is_start)
+
+    return event_position[positions], event_type[positions + 1]
+
+
+def build_trial_index(event_matrix, subject, consider_artefacts=True):
+    """
+    Function to build the index of the trials of interest of a subject, in the same order of find_trials
+
+    :param event_matrix: matrix of the events (position, type and duration for each event)
+    :param subject: index of the subject
+    :param consider_artefacts: True if trials labeled as artefacts in the dataset are considered, False otherwise
+    :return: TrialIndex of the trials
+    """
+
+    event_start, labels = find_trials(event_matrix, consider_artefacts)
+    clean_start, _ = find_trials(event_matrix, consider_artefacts=False)
+
+    # Each run starts with event 32766: the run of a trial is the number of runs started before it
+
+    run_start = event_matrix[event_matrix[:, 1] == 32766, 0]
+    run = np.searchsorted(run_start, event_start, side='right')
+
+    return TrialIndex(np.full(len(event_start), subject), run, event_start, labels - 769,
+                      ~np.isin(event_start, clean_start))
+
+
+def trial_window(fs, start_second, signal_length):
+    """
+    Function to evaluate the samples (relative to the start of the trial) of the signal of interest
+
+    :param fs: sampling frequency of the signal
+    :param start_second: second at which consider the start of the signal of interest
+    :param signal_length: length of the signal of interest
+    :return: array of the samples of the window
+    """
+
+    end_second = start_second + signal_length
+
+    return np.arange(int(start_second * fs), int(end_second * fs))
+
+
+def normalize_trials(trials):
+    """
+    Function to normalize in place each channel of each trial to unit L2 norm (channels with null norm are left
+    unchanged, as done by sklearn.preprocessing.normalize)
+
+    :param trials: data matrix to be normalized (n.trials x n.channels x n.samples)
+    :return: the same data matrix, normalized
+    """
+
+    norms = np.sqrt(np.einsum('ijk,ijk->ij', trials, trials))
+    norms[norms == 0] = 1
+    trials /= norms[:, :, np.newaxis]
+
+    return trials
+
+
+def epoch_trials(data, event_start, windows_sample, channel_elaboration='car', out=None, dtype=np.float64):
+    """
+    Function to cut the trials from the continuous signal, re-reference the channels and normalize them
+
+    :param data: continuous signal (n.samples x n.channels)
+    :param event_start: sample at which each trial starts
+    :param windows_sample: samples of the signal of interest, relative to the start of the trial
+    :param channel_elaboration: montage used for the re-referencing of the channels (name registered in
+    functions_montage, e.g. 'car', 'laplacian' or 'bipolar') or None
+    :param out: optional matrix (n.trials x n.channels x n.samples) in which the trials are written
+    :param dtype: data type of the trials (if out is not given)
+    :return: matrix of the trials (n.trials x n.channels x n.samples, n.channels depending on the montage)
+    """
+
+    event_start = np.asarray(event_start)
+    windows_sample = np.asarray(windows_sample)
+
+    if channel_elaboration is None:
+        n_channels = data.shape[1]
+    else:
+        matrix = montage_matrix(channel_elaboration, data.shape[1])
+        n_channels = matrix.shape[0]
+
+    if out is None:
+        out = np.empty((len(event_start), n_channels, len(windows_sample)), dtype=dtype)
+
+    # Gather the windows of all the trials with a single indexing operation (n.channels x n.trials x n.samples)
+
+    index = event_start[:, np.newaxis] + windows_sample[np.newaxis, :]
+
+    if channel_elaboration is None:
+        np.take(data.T, index, axis=1, out=out.transpose(1, 0, 2))
+    else:
+        # Re-referencing of all the trials with the spatial filter matrix of the montage (CAR, Laplacian, ...)
+        epochs = np.take(data.T, index, axis=1)
+        apply_montage(epochs.transpose(1, 0, 2), matrix, out=out)
+
+    return normalize_trials(out)
+
+
+def subject_sources(data_dir, subject):
+    """
+    :param data_dir: directory where data are saved (by dataloading.m) or HDF5 store (written by dataloading.py)
+    :param subject: index of the subject
+    :return: files from which the data of the subject are read
+    """
+
+    if is_store(data_dir):
+        return [data_dir]
+
+    return [data_dir + '/S' + str(subject) + '_data.mat', data_dir + '/S' + str(subject) + '_label.mat']
+
+
+def read_signal(data_dir, subject):
+    """
+    :param data_dir: directory where data are saved (by dataloading.m) or HDF5 store (written by dataloading.py)
+    :param subject: index of the subject
+    :return: continuous signal of the subject (n.samples x n.channels)
+    """
+
+    if is_store(data_dir):
+        return read_store_subject(data_dir, subject)[0]
+
+    return loadmat(data_dir + '/S' + str(subject) + '_data.mat')['data']
+
+
+def read_event_matrix(data_dir, subject):
+    """
+    :param data_dir: directory where data are saved (by dataloading.m) or HDF5 store (written by dataloading.py)
+    :param subject: index of the subject
+    :return: event matrix of the subject (position, type and duration of each event)
+    """
+
+    if is_store(data_dir):
+        return read_store_events(data_dir, subject)
+
+    return loadmat(data_dir + '/S' + str(subject) + '_label.mat')['event_matrix']
+
+
+def signal_shape(data_dir, subject):
+    """
+    :param data_dir: directory where data are saved (by dataloading.m) or HDF5 store (written by dataloading.py)
+    :param subject: index of the subject
+    :return: shape of the continuous signal of the subject, read from the header of the file (n.samples x n.channels)
+    """
+
+    if is_store(data_dir):
+        return store_data_shape(data_dir, subject)
+
+    return dict((name, shape) for name, shape, _ in whosmat(data_dir + '/S' + str(subject) + '_data.mat'))['data']
+
+
+def subject_cache_key(data_dir, subject, fs=250, start_second=2, signal_length=4, consider_artefacts=True,
+                      channel_elaboration='car', dtype=np.float64, storage_dtype=None):
+    """
+    Function to build the key of the trials of a subject inside the trials cache (see load_dataset)
+
+    :return: key of the cache entry and parameters from which it has been built
+    """
+
+    params = {'data_dir': os.path.abspath(data_dir), 'subject': subject, 'fs': fs, 'start_second': start_second,
+              'signal_length': signal_length, 'consider_artefacts': consider_artefacts,
+              'channel_elaboration': channel_elaboration, 'dtype': np.dtype(dtype).name,
+              'storage_dtype': np.dtype(dtype if storage_dtype is None else storage_dtype).name}
+
+    return 'S{}_'.format(subject) + cache_key(**params), params
+
+
+def dataset_cache_key(data_dir, subjects, **params):
+    """
+    Function to build the key of a dataset composed by several subjects (concatenated in the given order)
+
+    :param data_dir: directory where data are saved
+    :param subjects: indexes of the subjects
+    :param params: other parameters of load_dataset (fs, start_second, signal_length, consider_artefacts,
+    channel_elaboration, dtype, storage_dtype)
+    :return: key of the dataset and files from which it is read
+    """
+
+    keys = [subject_cache_key(data_dir, subject, **params)[0] for subject in subjects]
+    sources = [source for subject in subjects for source in subject_sources(data_dir, subject)]
 
-def load_dataset(data_dir, subject, fs=250, start_second=2, signal_length=4, consider_artefacts=True, channel_elaboration='car'):
+    return cache_key(subjects=keys), sorted(set(sources), key=sources.index)
+
+
+def load_cached_subject(data_dir, subject, cache_dir, fs=250, start_second=2, signal_length=4,
+                        consider_artefacts=True, channel_elaboration='car', dtype=np.float64, storage_dtype=None):
     """
-    Function for the loading of the dataset corresponding to a subject (and saved according to dataloading.m)
+    Function to retrieve the trials of a subject from the trials cache, without elaborating them if they are missing
 
     :param data_dir: directory where data are saved
+    :param subject: index of the subject
+    :param cache_dir: directory of the trials cache
+    :return: trials (read-only memory map, with the storage data type), labels (n.trials x 2) and TrialIndex of the
+    subject, None if they are not in the cache
+    """
+
+    key, _ = subject_cache_key(data_dir, subject, fs, start_second, signal_length, consider_artefacts,
+                               channel_elaboration, dtype, storage_dtype)
+    cached = load_cached_arrays(cache_dir, key, ['trials', 'labels'] + ['index_' + name for name in TrialIndex.columns],
+                                sources=subject_sources(data_dir, subject))
+
+    if cached is None:
+        return None
+
+    return cached['trials'], cached['labels'], TrialIndex.from_arrays(cached, prefix='index_')
+
+
+def load_dataset(data_dir, subject, fs=250, start_second=2, signal_length=4, consider_artefacts=True, channel_elaboration='car',
+                 cache_dir=None, dtype=np.float64, storage_dtype=None, return_index=False):
+    """
+    Function for the loading of the dataset corresponding to a subject (and saved according to dataloading.m). If a
+    cache directory is given, the elaborated trials are saved in it and the following calls with the same parameters
+    return them as read-only memory maps (the entry is recomputed if the .mat files of the subject change)
+
+    :param data_dir: directory where data are saved (by dataloading.m) or HDF5 store (written by dataloading.py)
     :param subject: index of the current subject
     :param fs: sampling frequency of the signal
     :param start_second: second at which consider the start of the signal of interest
     :param signal_length: length of the signal of interest
     :param consider_artefacts: True if trials labeled as artefacts in the dataset are considered, False otherwise
-    :return: dataset of the current subject and relative set of labels
+    :param channel_elaboration: montage used for the re-referencing of the channels ('car', 'laplacian', 'bipolar' or
+    any other montage registered in functions_montage) or None
+    :param cache_dir: directory of the trials cache (None to disable the cache)
+    :param dtype: data type of the trials (np.float32 to halve memory and bandwidth in the whole pipeline)
+    :param storage_dtype: data type of the trials saved in the cache (e.g. np.float16), converted to dtype when they
+    are read (None to save them with dtype)
+    :param return_index: True to return also the TrialIndex of the trials (saved in the cache together with them)
+    :return: dataset of the current subject and relative set of labels (and TrialIndex, if return_index = True)
     """
 
+    # Check if the trials have already been elaborated with the same parameters
+
+    if cache_dir is not None:
+        cached = load_cached_subject(data_dir, subject, cache_dir, fs, start_second, signal_length,
+                                     consider_artefacts, channel_elaboration, dtype, storage_dtype)
+        if cached is not None:
+            trials = cached[0] if cached[0].dtype == dtype else cached[0].astype(dtype)
+            if return_index:
+                return trials, cached[1].tolist(), cached[2]
+            return trials, cached[1].tolist()
+
     # Retrieve of data
 
-    i = subject
-    path_data = data_dir + '/S' + str(i) + '_data.mat'
-    path_event = data_dir + '/S' + str(i) + '_label.mat'
+    data = read_signal(data_dir, subject)
+    event_matrix = read_event_matrix(data_dir, subject)
 
-    data = loadmat(path_data)['data']
-    event_matrix = loadmat(path_event)['event_matrix']
+    # Find the trials of interest and cut them from the signal
 
-    event_position = event_matrix[:, 0]
-    event_type = event_matrix[:, 1]
+    index = build_trial_index(event_matrix, subject, consider_artefacts)
+    windows_sample = trial_window(fs, start_second, signal_length)
 
-    positions = []
-    ends = []
-    labels = []
+    trials = epoch_trials(data, index.sample, windows_sample, channel_elaboration, dtype=dtype)
 
-    # Find the samples at which the signal of interest starts (labeled as 768 and 1023 - if consider_artefacts =
-    # True) and followed by label 769 (left hand) or 770 (right hand)
+    # Creation of the label list
 
-    start_types = [768, 1023 if consider_artefacts is True else None]
+    new_labels = index.one_hot()
 
-    for l in range(len(event_type)):
-        if event_type[l] in start_types and event_type[l + 1] == 769:
-            positions.append(l)
-            ends.append(l + 1)
-            labels.append(769)
+    if cache_dir is not None:
+        key, params = subject_cache_key(data_dir, subject, fs, start_second, signal_length, consider_artefacts,
+                                        channel_elaboration, dtype, storage_dtype)
+        stored = trials if storage_dtype is None else trials.astype(storage_dtype)
+        save_cached_arrays(cache_dir, key, dict({'trials': stored, 'labels': new_labels}, **index.to_arrays('index_')),
+                           sources=subject_sources(data_dir, subject), params=params)
 
-        if event_type[l] in start_types and event_type[l + 1] == 770:
-            positions.append(l)
-            ends.append(l + 1)
-            labels.append(770)
+        # The trials are returned as they will be read from the cache, so that the results do not depend on the
+        # presence of the entry
 
-    event_start = event_position[positions]
-    event_end = event_position[ends]
+        trials = stored.astype(dtype, copy=False)
 
-    # Evaluate the samples  window
+    if return_index:
+        return trials, new_labels.tolist(), index
+    return trials, new_labels.tolist()
 
-    end_second = start_second + signal_length
-    windows_sample = np.linspace(int(start_second * fs), int(end_second * fs) - 1,
-                                 int(end_second * fs) - int(start_second * fs)).astype(int)
-
-    # Creation of the trials matrix and data normalization
-
-    trials = np.zeros((len(event_start), data.shape[1], len(windows_sample)))
-    data = data.T
-
-    for j in range(trials.shape[0]):
-        d = data[:, event_start[j] + windows_sample]
-
-        if channel_elaboration == 'car':
-            # CAR
-            # info = mne.create_info(22, 250, ch_types='eeg')
-            # raw = mne.io.RawArray(d, info)
-            # d_elab = mne.set_eeg_reference(raw, 'average', verbose=50)[0].get_data(None)
-            # d_elab = np.array(d_elab)
-
-            mean = np.mean(d, axis=0)
-            d_elab = d - mean
-
-        elif channel_elaboration == 'laplacian':
-            # LAPLACIAN
-            near_channels = {1: [4], 2: [3, 8], 3: [2, 4, 9], 4: [3, 5, 10], 5: [4, 6, 11], 6: [5, 12],
-                             7: [8], 8: [2, 7, 9, 14], 9: [3, 8, 10, 15], 10: [4, 9, 11, 16], 11: [5, 10, 12, 17],
-                             12: [6, 11, 13, 18], 13: [12], 14: [8, 15], 15: [9, 14, 16, 19], 16:  [10, 15, 17, 20],
-                             17: [11, 16, 18, 21], 18: [12, 17], 19: [15, 20], 20: [16, 19, 21, 22],
-                             21: [17, 20], 22: [20]}
-            d_elab = []
-            for channel in near_channels.keys():
-                near_channel = near_channels[channel]
-                y = 0
-                for n in near_channel:
-                    y += d[n-1]
-                x = d[channel-1] - y/len(near_channel)
-                d_elab.append(x)
-            d_elab = np.array(d_elab)
 
+def subject_shape(data_dir, subject, fs=250, start_second=2, signal_length=4, consider_artefacts=True,
+                  channel_elaboration='car'):
+    """
+    Function to evaluate the shape of the dataset of a subject from its event matrix, without loading its signal
+
+    :param data_dir: directory where data are saved
+    :param subject: index of the subject
+    :param fs: sampling frequency of the signal
+    :param start_second: second at which consider the start of the signal of interest
+    :param signal_length: length of the signal of interest
+    :param consider_artefacts: True if trials labeled as artefacts in the dataset are considered, False otherwise
+    :param channel_elaboration: montage used for the re-referencing of the channels or None
+    :return: shape of the trials matrix returned by load_dataset (n.trials x n.channels x n.samples)
+    """
+
+    event_start, _ = find_trials(read_event_matrix(data_dir, subject), consider_artefacts)
+
+    n_channels = signal_shape(data_dir, subject)[1]
+    if channel_elaboration is not None:
+        n_channels = montage_matrix(channel_elaboration, n_channels).shape[0]
+
+    return len(event_start), n_channels, len(trial_window(fs, start_second, signal_length))
+
+
+def load_subjects(data_dir, subjects, fs=250, start_second=2, signal_length=4, consider_artefacts=True,
+                  channel_elaboration='car', cache_dir=None, n_jobs=None, dtype=np.float64, storage_dtype=None,
+                  return_index=False):
+    """
+    Function for the loading of the dataset composed by several subjects. The subjects are loaded in parallel (with a
+    pool of processes, only for the ones not already in the cache) and written directly in a single trials matrix,
+    sized in advance from the event matrices
+
+    :param data_dir: directory where data are saved
+    :param subjects: indexes of the subjects
+    :param fs: sampling frequency of the signal
+    :param start_second: second at which consider the start of the signal of interest
+    :param signal_length: length of the signal of interest
+    :param consider_artefacts: True if trials labeled as artefacts in the dataset are considered, False otherwise
+    :param channel_elaboration: montage used for the re-referencing of the channels or None
+    :param cache_dir: directory of the trials cache (None to disable the cache)
+    :param n_jobs: number of processes (None to use all the processors, 1 to load the subjects sequentially)
+    :param dtype: data type of the trials
+    :param storage_dtype: data type of the trials saved in the cache (None to save them with dtype)
+    :param return_index: True to return also the TrialIndex of all the trials
+    :return: dataset of all the subjects (n.trials x n.channels x n.samples) and relative labels (n.trials x 2) (and
+    TrialIndex, if return_index = True)
+    """
+
+    subjects = list(subjects)
+    params = dict(fs=fs, start_second=start_second, signal_length=signal_length,
+                  consider_artefacts=consider_artefacts, channel_elaboration=channel_elaboration)
+
+    # Allocation of the whole dataset: the trials of each subject are placed one after the other
+
+    shapes = [subject_shape(data_dir, subject, **params) for subject in subjects]
+    offsets = np.cumsum([0] + [shape[0] for shape in shapes])
+
+    params.update(dtype=dtype, storage_dtype=storage_dtype)
+
+    trials = np.empty((offsets[-1],) + shapes[0][1:], dtype=dtype)
+    labels = np.empty((offsets[-1], 2), dtype=int)
+    indexes = [None] * len(subjects)
+
+    def store(k, result):
+        d, l, indexes[k] = result
+        if len(d) != offsets[k + 1] - offsets[k]:
+            raise ValueError('Subject {}: expected {} trials, found {}'.format(subjects[k], offsets[k + 1] - offsets[k],
+                                                                               len(d)))
+        trials[offsets[k]:offsets[k + 1]] = d
+        labels[offsets[k]:offsets[k + 1]] = l
+
+    # Subjects already in the cache are read directly, the others are elaborated in parallel
+
+    pending = []
+
+    for k, subject in enumerate(subjects):
+        cached = None
+        if cache_dir is not None:
+            cached = load_cached_subject(data_dir, subject, cache_dir, **params)
+        if cached is not None:
+            store(k, cached)
         else:
-            d_elab = d
+            pending.append(k)
 
-        trials[j, :, :] = normalize(d_elab, axis=1)
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
 
-    # Creation of the label list
+    if n_jobs == 1 or len(pending) <= 1:
+        for k in pending:
+            store(k, load_dataset(data_dir, subjects[k], cache_dir=cache_dir, return_index=True, **params))
+
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(pending))) as executor:
+            futures = {executor.submit(load_dataset, data_dir, subjects[k], cache_dir=cache_dir, return_index=True,
+                                       **params): k for k in pending}
+
+            for future in as_completed(futures):
+                store(futures[future], future.result())
+
+    if return_index:
+        return trials, labels, TrialIndex.concatenate(indexes)
+    return trials, labels
+
+
+def cache_subject(data_dir, subject, cache_dir, **params):
+    # Elaboration of a subject only to save it in the trials cache (nothing is returned, so that the trials are not
+    # sent back by the worker processes)
+
+    load_dataset(data_dir, subject, cache_dir=cache_dir, **params)
+
+
+def cache_subjects(data_dir, subjects, cache_dir, n_jobs=None, **params):
+    """
+    Function to elaborate the subjects not yet in the trials cache, in parallel with a pool of processes (as in
+    load_subjects), without loading their trials
+
+    :param data_dir: directory where data are saved
+    :param subjects: indexes of the subjects
+    :param cache_dir: directory of the trials cache
+    :param n_jobs: number of processes (None to use all the processors, 1 to elaborate the subjects sequentially)
+    :param params: other parameters of load_dataset (fs, start_second, signal_length, consider_artefacts,
+    channel_elaboration, dtype, storage_dtype)
+    :return: subjects that have been elaborated
+    """
+
+    pending = [subject for subject in subjects if load_cached_subject(data_dir, subject, cache_dir, **params) is None]
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+
+    if n_jobs == 1 or len(pending) <= 1:
+        for subject in pending:
+            cache_subject(data_dir, subject, cache_dir, **params)
 
-    new_labels = []
-    labels_name = {769: [1, 0], 770: [0, 1]}
-    for j in range(len(labels)):
-        new_labels.append(labels_name[labels[j]])
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(pending))) as executor:
+            futures = [executor.submit(cache_subject, data_dir, subject, cache_dir, **params) for subject in pending]
 
-    return trials, new_labels
+            for future in as_completed(futures):
+                future.result()
+
+    return pending
 
 
 def create_dict(dataset, labels):
@@ -133,20 +470,12 @@ def create_dict(dataset, labels):
     :return: dictionary related to the dataset
     """
 
-    # According to its label, each trial is appended to one or the other list
-
-    values1 = []
-    values2 = []
-
-    for i in range(len(labels)):
-        if (labels[i] == [1, 0]).all():
-            values1.append(dataset[i])
-        else:
-            values2.append(dataset[i])
+    # According to its label, each trial is assigned to one or the other class (with a single gather for each one)
 
-    # Dictionary creation with the previous lists
+    left = np.all(np.asarray(labels) == [1, 0], axis=1)
+    dataset = np.asarray(dataset)
 
-    data_dict = {1: np.array(values1), 2: np.array(values2)}
+    data_dict = {1: dataset[left], 2: dataset[~left]}
 
     return data_dict
 
@@ -180,92 +509,312 @@ def extract_indexes_segments(data_length, n_segments):
     return indexes
 
 
-def extract_wt(matrix):
+def extract_wt(matrix, wavelet='sym9', level=1, mode='symmetric', out=None):
     """
     Extract the approximation component obtained with wavelet decomposition of each channel of each trial inside the
-    data matrix
+    data matrix. The whole matrix is transformed at once along the samples axis
 
     :param matrix: data matrix for each the wavelet will be calculated (n.trials x n.channels x n.samples)
+    :param wavelet: wavelet used for the decomposition
+    :param level: level of the decomposition (the approximation component of the last level is returned)
+    :param mode: signal extension mode at the borders (as in pywt)
+    :param out: optional preallocated output matrix (n.trials x n.channels x n.coefficients)
     :return: matrix containing the approximation components of data
     """
 
-    approx_trials = []
+    matrix = np.asarray(matrix)
 
-    for trial in matrix:
-        approx = []
+    if level == 1:
+        ca, _ = pywt.dwt(matrix, wavelet, mode=mode, axis=-1)
+    else:
+        ca = pywt.wavedec(matrix, wavelet, mode=mode, level=level, axis=-1)[0]
 
-        for channel in trial:
-            # For the signals coming from each channel, extract the corresponding wavelet decomposition
+    if out is None:
+        return ca
 
-            ca, _ = pywt.dwt(channel, 'sym9')
+    out[...] = ca
 
-            approx.append(ca)
+    return out
 
-        approx_trials.append(approx)
 
-    return np.array(approx_trials)
-
-
-def extract_psd(matrix, fs=250):
+def extract_psd(matrix, fs=250, nperseg=256, noverlap=None, method='welch', bands=None, out=None):
     """
-    Extract the power spectral density of each channel of each trial inside the data matrix
+    Extract the power spectral density of each channel of each trial inside the data matrix. The whole matrix is
+    elaborated at once along the samples axis
 
     :param matrix: data matrix for each the psd will be calculated (n.trials x n.channels x n.samples)
     :param fs: sampling frequency of the data
+    :param nperseg: length of the segments of the Welch method (number of frequency bins: nperseg / 2 + 1)
+    :param noverlap: number of overlapping samples between segments (None for nperseg / 2)
+    :param method: 'welch', 'periodogram' (single FFT of the whole signal) or 'multitaper' (average of the
+    periodograms obtained with the DPSS tapers)
+    :param bands: optional list of (low frequency, high frequency) pairs: only the bins inside them are kept
+    :param out: optional preallocated output matrix (n.trials x n.channels x n.bins)
     :return: matrix containing the psd instead of the signal samples
     """
 
-    fft_dataset = np.zeros((matrix.shape[0], matrix.shape[1], 129))
+    matrix = np.asarray(matrix)
+
+    if method == 'welch':
+        freqs, psd = signal.welch(matrix, fs=fs, nperseg=nperseg, noverlap=noverlap, axis=-1)
+    elif method == 'periodogram':
+        freqs, psd = signal.periodogram(matrix, fs=fs, axis=-1)
+    elif method == 'multitaper':
+        freqs, psd = multitaper_psd(matrix, fs)
+    else:
+        raise ValueError('Unknown PSD method: {}'.format(method))
+
+    if bands is not None:
+        selected = np.zeros(len(freqs), dtype=bool)
+        for low, high in bands:
+            selected |= (freqs >= low) & (freqs <= high)
+        psd = psd[..., selected]
+
+    if out is None:
+        out = np.empty(psd.shape, dtype=matrix.dtype)
+    out[...] = psd
+
+    return out
+
+
+def multitaper_psd(matrix, fs=250, half_bandwidth=4):
+    """
+    Multitaper estimation of the power spectral density along the last axis (with 2 * half_bandwidth - 1 DPSS tapers)
+
+    :param matrix: data matrix (n.trials x n.channels x n.samples)
+    :param fs: sampling frequency of the data
+    :param half_bandwidth: time-half bandwidth product of the tapers
+    :return: frequencies and matrix of the psd (one-sided, same scaling of scipy.signal.welch)
+    """
 
-    for t, trial in enumerate(matrix):
+    n_samples = matrix.shape[-1]
+    tapers = signal.windows.dpss(n_samples, half_bandwidth, Kmax=2 * half_bandwidth - 1)
 
-        trial = np.matrix(trial)
+    # Tapers have unit energy: the mean of the tapered periodograms is a density after the division by fs
 
-        for i in range(trial.shape[0]):
-            # For the signals coming from each channel, extract the corresponding psd
+    spectra = np.fft.rfft(signal.detrend(matrix, axis=-1, type='constant')[..., np.newaxis, :] * tapers, axis=-1)
+    psd = np.mean(np.abs(spectra) ** 2, axis=-2) / fs
 
-            data = trial[i, :]
-            freqs, psd = signal.welch(data, fs=fs)
-            fft_dataset[t, i, :] = psd
+    psd[..., 1:(n_samples + 1) // 2] *= 2
 
-    return np.array(fft_dataset)
+    return np.fft.rfftfreq(n_samples, 1 / fs), psd
 
 
 def extract_statistical_characteristics(matrix):
     """
-    Extract the statistical characteristics of the channels and between the channels in each trial
+    Extract the statistical characteristics of the channels and between the channels in each trial. All the trials and
+    channels are elaborated at once along the samples axis
 
     :param matrix: data matrix for each the characteristics will be calculated (n.trials x n.channels x n.samples)
     :return: matrix containing the standard characteristics of data
     """
 
-    sc_dataset = np.zeros((matrix.shape[0], matrix.shape[1], matrix.shape[1] + 10))
-
-    for t, trial in enumerate(matrix):
-        trial = np.matrix(trial)
+    matrix = np.asarray(matrix)
+    sc_dataset = np.zeros((matrix.shape[0], matrix.shape[1], matrix.shape[1] + 10), dtype=matrix.dtype)
 
-        for i in range(trial.shape[0]):
-            # For the signals coming from each channel, extract the corresponding statistical characteristics
+    # Statistical characteristics of the signals coming from each channel
 
-            data = trial[i, :]
-            sc = scipy.stats.describe(data, axis=1)
-            sc_dataset[t, i, 0] = sc.mean
-            sc_dataset[t, i, 1] = np.mean(np.square(data))
-            sc_dataset[t, i, 2] = sc.variance
-            sc_dataset[t, i, 3] = sc.skewness
-            sc_dataset[t, i, 4] = sc.kurtosis
-            sc_dataset[t, i, 5] = entropy(data, axis=1)
-            sc_dataset[t, i, 6] = np.trapz(np.array(data), axis=1)  # area under the (rectified) curve
-            sc_dataset[t, i, 7] = len(data) - np.count_nonzero(data)  # number of zero-crossing
-            sc_dataset[t, i, 8] = np.max(data) - np.min(data)  # peak-to-peak
-            sc_dataset[t, i, 9] = 0
+    sc = scipy.stats.describe(matrix, axis=2)
+    sc_dataset[:, :, 0] = sc.mean
+    sc_dataset[:, :, 1] = np.mean(np.square(matrix), axis=2)
+    sc_dataset[:, :, 2] = sc.variance
+    sc_dataset[:, :, 3] = sc.skewness
+    sc_dataset[:, :, 4] = sc.kurtosis
+    sc_dataset[:, :, 5] = entropy(matrix, axis=2)
+    sc_dataset[:, :, 6] = np.trapz(matrix, axis=2)  # area under the (rectified) curve
+    sc_dataset[:, :, 7] = 1 - np.count_nonzero(matrix, axis=2)  # number of zero-crossing (as computed on 1 x n.samples
+    # matrices, whose length is 1)
+    sc_dataset[:, :, 8] = np.max(matrix, axis=2) - np.min(matrix, axis=2)  # peak-to-peak
 
-        sc_dataset[t, :, 10:] = np.corrcoef(trial)  # Pearson Correlation Coefficients between channels
+    sc_dataset[:, :, 10:] = batch_corrcoef(matrix)  # Pearson Correlation Coefficients between channels
 
     # Replace possible -inf values with -5 (other are between -1 and 1)
     sc_dataset = np.nan_to_num(sc_dataset, neginf=-5)
 
-    return np.array(sc_dataset)
+    return sc_dataset
+
+
+def batch_corrcoef(matrix):
+    """
+    Pearson correlation coefficients between the channels of each trial, as computed by np.corrcoef
+
+    :param matrix: data matrix (n.trials x n.channels x n.samples)
+    :return: correlation matrices (n.trials x n.channels x n.channels)
+    """
+
+    # As in np.corrcoef, the computation is done at least in double precision
+
+    matrix = np.asarray(matrix, dtype=np.result_type(matrix, np.float64))
+    centered = matrix - np.mean(matrix, axis=2, keepdims=True)
+    covariance = np.matmul(centered, centered.transpose(0, 2, 1))
+    covariance *= np.true_divide(1, matrix.shape[2] - 1)
+
+    std = np.sqrt(np.diagonal(covariance, axis1=1, axis2=2).real)
+    covariance /= std[:, :, np.newaxis]
+    covariance /= std[:, np.newaxis, :]
+
+    return np.clip(covariance, -1, 1)
+
+
+def statistical_sums(matrix, shift):
+    """
+    Additive statistics of the signals of each channel (sums over the samples): the statistics of a signal are the sum
+    of the ones of its segments, so that they can be updated when a segment changes
+
+    :param matrix: data matrix (n.trials x n.channels x n.samples)
+    :param shift: value subtracted from each channel before the power sums (n.trials x n.channels), usually its mean,
+    to limit the cancellation errors
+    :return: dictionary of the statistics of each channel (and of each pair of channels for 'cross')
+    """
+
+    matrix = np.asarray(matrix, dtype=np.result_type(matrix, np.float64))
+    shifted = matrix - shift[:, :, np.newaxis]
+    squared = np.square(shifted)
+
+    positive = np.maximum(matrix, 0)
+    negative = np.maximum(-matrix, 0)
+
+    return {'p1': np.sum(shifted, axis=2), 'p2': np.sum(squared, axis=2), 'p3': np.sum(squared * shifted, axis=2),
+            'p4': np.sum(np.square(squared), axis=2), 'cross': np.matmul(shifted, shifted.transpose(0, 2, 1)),
+            'nonzero': np.count_nonzero(matrix, axis=2), 'n_positive': np.count_nonzero(positive, axis=2),
+            'n_negative': np.count_nonzero(negative, axis=2), 'positive_xlogx': np.sum(xlogy(positive, positive), axis=2),
+            'negative_xlogx': np.sum(xlogy(negative, negative), axis=2)}
+
+
+def statistical_characteristics_from_sums(sums, shift, n_samples, maximum, minimum, endpoints, dtype=np.float64):
+    """
+    Statistical characteristics of extract_statistical_characteristics computed from the additive statistics of the
+    signals (equal to the ones computed on the signals up to rounding errors)
+
+    :param sums: statistics of the signals (see statistical_sums)
+    :param shift: value subtracted from each channel in the power sums (n.trials x n.channels)
+    :param n_samples: number of samples of the signals
+    :param maximum: maximum of each channel (n.trials x n.channels)
+    :param minimum: minimum of each channel (n.trials x n.channels)
+    :param endpoints: sum of the first and last sample of each channel (n.trials x n.channels)
+    :param dtype: data type of the characteristics
+    :return: matrix containing the standard characteristics of data
+    """
+
+    n = n_samples
+    p1, p2, p3, p4 = sums['p1'], sums['p2'], sums['p3'], sums['p4']
+    total = p1 + n * shift
+
+    # Central moments from the power sums of the shifted signals
+
+    mu = p1 / n
+    m2 = p2 / n - mu ** 2
+    m3 = p3 / n - 3 * mu * p2 / n + 2 * mu ** 3
+    m4 = p4 / n - 4 * mu * p3 / n + 6 * mu ** 2 * p2 / n - 3 * mu ** 4
+
+    sc_dataset = np.zeros(shift.shape + (shift.shape[1] + 10,), dtype=dtype)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Entropy of the signal normalized by its sum: -inf if some samples have the opposite sign of the sum
+
+        magnitude = np.abs(total)
+        h = np.where(total > 0, sums['positive_xlogx'], sums['negative_xlogx']) / -magnitude + np.log(magnitude)
+        h[np.where(total > 0, sums['n_negative'], sums['n_positive']) > 0] = -np.inf
+        h[total == 0] = np.nan
+
+        covariance = (sums['cross'] - p1[:, :, np.newaxis] * p1[:, np.newaxis, :] / n) / (n - 1)
+        std = np.sqrt(np.diagonal(covariance, axis1=1, axis2=2))
+
+        sc_dataset[:, :, 0] = shift + mu
+        sc_dataset[:, :, 1] = (p2 + 2 * shift * p1) / n + shift ** 2
+        sc_dataset[:, :, 2] = m2 * n / (n - 1)
+        sc_dataset[:, :, 3] = m3 / m2 ** 1.5
+        sc_dataset[:, :, 4] = m4 / m2 ** 2 - 3
+        sc_dataset[:, :, 5] = h
+        sc_dataset[:, :, 6] = total - endpoints / 2
+        sc_dataset[:, :, 7] = 1 - sums['nonzero']
+        sc_dataset[:, :, 8] = maximum - minimum
+        sc_dataset[:, :, 10:] = np.clip(covariance / std[:, :, np.newaxis] / std[:, np.newaxis, :], -1, 1)
+
+    return np.nan_to_num(sc_dataset, neginf=-5)
+
+
+def extract_features_chunked(function_features, trials, out=None, chunk_size=64, n_jobs=1, n_trials=None,
+                             **params):
+    """
+    Function to apply a feature extraction function to a dataset one chunk of trials at a time, writing the features
+    in the output as soon as they are computed: the memory used is bounded by a few chunks, whatever the size of the
+    dataset. Only the functions elaborating each trial independently can be used (extract_wt, extract_psd,
+    extract_statistical_characteristics, not extractFBCSP)
+
+    :param function_features: function for the feature extraction
+    :param trials: trials matrix (n.trials x n.channels x n.samples, also a memory map or a TrialDataset) or iterable
+    of chunks of trials
+    :param out: output matrix (also a memory map), path of the .npy file to be created (as a memory map) or None to
+    allocate it in memory
+    :param chunk_size: number of trials in each chunk (not used if trials is an iterable of chunks)
+    :param n_jobs: number of threads elaborating the chunks in parallel
+    :param n_trials: total number of trials, needed to allocate the output if trials is an iterable of chunks (except
+    for lists and tuples of chunks)
+    :param params: other parameters of function_features
+    :return: matrix of the features of all the trials
+    """
+
+    from lazy_dataset import TrialDataset
+
+    # Arrays (also memory maps) and datasets are read in chunks, any other object is an iterable of chunks
+
+    if isinstance(trials, (np.ndarray, TrialDataset)):
+        n_trials = len(trials)
+        chunks = (trials[start:start + chunk_size] for start in range(0, n_trials, chunk_size))
+    else:
+        if n_trials is None and isinstance(trials, (list, tuple)):
+            n_trials = sum(len(chunk[0] if isinstance(chunk, tuple) else chunk) for chunk in trials)
+        chunks = iter(trials)
+
+    def elaborate(chunk):
+        # TrialDataset returns the labels together with the trials
+        if isinstance(chunk, tuple):
+            chunk = chunk[0]
+        return function_features(np.asarray(chunk), **params)
+
+    def write(features, start):
+        nonlocal out
+
+        # The output is allocated when the shape of the features is known
+
+        if out is None or isinstance(out, str):
+            if n_trials is None:
+                raise ValueError('The number of trials is needed to allocate the output')
+            shape = (n_trials,) + features.shape[1:]
+            if out is None:
+                out = np.empty(shape, dtype=features.dtype)
+            else:
+                out = np.lib.format.open_memmap(out, mode='w+', dtype=features.dtype, shape=shape)
+
+        out[start:start + len(features)] = features
+
+        return start + len(features)
+
+    position = 0
+
+    if n_jobs == 1:
+        for chunk in chunks:
+            position = write(elaborate(chunk), position)
+
+    else:
+        # At most 2 chunks for each thread are elaborated or waiting to be written
+
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            pending = deque()
+
+            for chunk in chunks:
+                pending.append(executor.submit(elaborate, chunk))
+                if len(pending) >= 2 * n_jobs:
+                    position = write(pending.popleft().result(), position)
+
+            while pending:
+                position = write(pending.popleft().result(), position)
+
+    if hasattr(out, 'flush'):
+        out.flush()
+
+    return out
 
 
 def extractFBCSP(matrix, labels, n_features, fs=250):
@@ -276,27 +825,56 @@ def extractFBCSP(matrix, labels, n_features, fs=250):
     :param labels: labels corresponding to the trials in the data matrix
     :param n_features: minimum number of features to be extracted
     :param fs: sampling frequency of data
-    :return: data matrix with the features extracted for each trial
+    :return: data matrix with the features extracted for each trial (in the same order of the trials in the data
+    matrix, as the features of FBCSP_V4.extractFeatures)
+    """
+
+    # Extraction of the FBCSP feature for the current dictionary (it returns two matrices of features, one for each
+    # label, that are placed back in the rows of the trials of the class as selected by create_dict)
+
+    FBCSP_f = fit_fbcsp(matrix, labels, n_features, fs)
+    features_1, features_2 = FBCSP_f.extractFeaturesForTraining()
+
+    left = np.all(np.asarray(labels) == [1, 0], axis=1)
+
+    fbcsp = np.empty((len(left), features_1.shape[1]))
+    fbcsp[left] = features_1
+    fbcsp[~left] = features_2
+
+    return reshape_fbcsp(fbcsp, n_features)
+
+
+def fit_fbcsp(matrix, labels, n_features, fs=250):
+    """
+    Training of the FBCSP Class on the trials, as done by extractFBCSP. The trained object can be used to compute the
+    features of perturbed versions of the trials (e.g. passed as fbcsp to ablation and permutation)
+
+    :param matrix: data matrix of the trials
+    :param labels: labels corresponding to the trials in the data matrix
+    :param n_features: minimum number of features to be extracted
+    :param fs: sampling frequency of data
+    :return: trained FBCSP_V4 object
     """
 
     # Creation of the dictionary corresponding to the data matrix
 
     trials_dict = create_dict(matrix, labels)
 
-    # Extraction of the FBCSP feature for the current dictionary and concatenation (needed because it returns two
-    # matrices of features, one for each label
+    return FBCSP_V4(trials_dict, fs, n_w=22, n_features=n_features, print_var=True)
 
-    FBCSP_f = FBCSP_V4(trials_dict, fs, n_w=22, n_features=n_features, print_var=True)
-    fbcsp = FBCSP_f.extractFeaturesForTraining()
-    fbcsp = np.concatenate((fbcsp[0], fbcsp[1]), axis=0)
+
+def reshape_fbcsp(fbcsp, n_features):
+    """
+    :param fbcsp: FBCSP features of the trials (n.trials x n.selected features)
+    :param n_features: minimum number of features (the missing ones are set to zero)
+    :return: features reshaped for the subsequent training (n.trials x 1 x n.features)
+    """
 
     if fbcsp.shape[1] < n_features:
         pad = np.zeros((fbcsp.shape[0], n_features))
         pad[:, :fbcsp.shape[1]] = fbcsp
         fbcsp = pad
 
-    # Reshape for the subsequent training
-
     fbcsp = fbcsp.reshape((fbcsp.shape[0], 1, fbcsp.shape[1]))
 
     return np.array(fbcsp)
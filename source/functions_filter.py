@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+import scipy.signal
+
+
+@lru_cache(maxsize=None)
+def bandpass_sos(order, lowcut, highcut, fs):
+    """
+    Function to design a Butterworth pass band filter in second-order sections. The design is computed once for each
+    combination of parameters and then reused
+
+    :param order: order of the filter
+    :param lowcut: low frequency of the pass band
+    :param highcut: high frequency of the pass band
+    :param fs: sampling frequency of the signal (2 if the frequencies are normalized in [0, 1] as in scipy.signal)
+    :return: second-order sections of the filter (read-only, n.sections x 6)
+    """
+
+    sos = scipy.signal.butter(order, [lowcut, highcut], btype='bandpass', fs=fs, output='sos')
+    sos.setflags(write=False)
+
+    return sos
+
+
+def filter_trials(trials, sos, axis=-1):
+    """
+    Zero-phase filtering (forward and backward) of all the trials at once
+
+    :param trials: signals to be filtered (e.g. n.trials x n.channels x n.samples)
+    :param sos: second-order sections of the filter
+    :param axis: axis of the samples
+    :return: filtered signals, with the same shape of trials
+    """
+
+    # The sections are copied since scipy requires them writable (the cached designs are read-only)
+
+    return scipy.signal.sosfiltfilt(np.array(sos), trials, axis=axis)
+
+
+def filter_bank(trials, bands, fs, order=3, axis=-1, n_jobs=None, out=None):
+    """
+    Function to filter the trials in several pass bands. The bands are filtered in parallel by a pool of threads (the
+    filtering of scipy releases the GIL), each one writing directly in its slice of the output
+
+    :param trials: signals to be filtered (e.g. n.trials x n.channels x n.samples)
+    :param bands: list of (low frequency, high frequency) pairs
+    :param fs: sampling frequency of the signal
+    :param order: order of the filters
+    :param axis: axis of the samples
+    :param n_jobs: number of threads (None to use all the processors, 1 to filter the bands sequentially)
+    :param out: optional preallocated output (n.bands x trials shape), e.g. with a lower precision
+    :return: filtered signals (n.bands x trials shape)
+    """
+
+    soses = [bandpass_sos(order, low, high, fs) for low, high in bands]
+
+    if out is None:
+        out = np.empty((len(soses),) + np.shape(trials), dtype=np.result_type(trials, np.float64))
+
+    def filter_band(b):
+        out[b] = filter_trials(trials, soses[b], axis)
+
+    if n_jobs == 1 or len(soses) <= 1:
+        for b in range(len(soses)):
+            filter_band(b)
+
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(filter_band, range(len(soses))))
+
+    return out
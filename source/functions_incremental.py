@@ -0,0 +1,236 @@
+import numpy as np
+import pywt
+from scipy import signal
+
+from functions_dataset import extract_wt, extract_psd, extract_statistical_characteristics, statistical_sums, \
+    statistical_characteristics_from_sums
+from functions_cache import unwrap_extractor
+
+# Signal extension modes for which the coefficients near the borders depend only on the samples near the borders
+# (as assumed by IncrementalWavelet). The periodic modes use the samples of the opposite border, while with reflect,
+# antireflect and smooth the extension of a window differs from the one of the whole signal if their lengths have a
+# different parity
+INCREMENTAL_WAVELET_MODES = ('symmetric', 'antisymmetric', 'zero', 'constant')
+
+class IncrementalWavelet:
+    """
+    Approximation coefficients (as in extract_wt) of a dataset and of its perturbed versions. The coefficients of the
+    original dataset are computed once: when a segment of the signals is modified, only the coefficients whose support
+    overlaps the segment are computed again
+    """
+
+    def __init__(self, dataset, wavelet='sym9', mode='symmetric', baseline=None):
+        """
+        :param dataset: original dataset (n.trials x n.channels x n.samples)
+        :param wavelet: wavelet used for the decomposition
+        :param mode: signal extension mode at the borders (one of INCREMENTAL_WAVELET_MODES)
+        :param baseline: approximation coefficients of the original dataset, if already computed
+        """
+
+        if mode not in INCREMENTAL_WAVELET_MODES:
+            raise ValueError('Mode not supported by IncrementalWavelet: {}'.format(mode))
+
+        self.wavelet = wavelet
+        self.mode = mode
+        self.n_samples = dataset.shape[-1]
+        self.filter_length = pywt.Wavelet(wavelet).dec_len
+        self.baseline = extract_wt(dataset, wavelet, mode=mode) if baseline is None else baseline
+
+    def affected_coefficients(self, start, end):
+        """
+        :param start: first modified sample
+        :param end: last modified sample (excluded)
+        :return: first and last (excluded) approximation coefficients depending on the modified samples
+        """
+
+        n_coefficients = self.baseline.shape[-1]
+
+        # Coefficient k is computed from samples 2k + 2 - filter_length ... 2k + 1; the samples near the borders are
+        # also used by the extension of the signal, which is involved in the first and last coefficients
+
+        first = 0 if start < self.filter_length - 1 else start // 2
+        last = n_coefficients if end > self.n_samples - self.filter_length + 1 else (end + self.filter_length - 1) // 2
+
+        return first, min(last, n_coefficients)
+
+    def __call__(self, data, start, end):
+        """
+        :param data: perturbed dataset, equal to the original one except for the samples from start to end
+        :param start: first modified sample
+        :param end: last modified sample (excluded)
+        :return: approximation coefficients of the perturbed dataset
+        """
+
+        first, last = self.affected_coefficients(start, end)
+
+        # Samples needed by the affected coefficients: the window starts at an even sample (to keep the alignment of
+        # the decimation) and it is extended to the borders when the extension of the signal is involved
+
+        low = 2 * first + 2 - self.filter_length
+        high = 2 * last
+
+        low = 0 if low < 0 else low - low % 2
+        high = self.n_samples if high > self.n_samples else high
+
+        ca, _ = pywt.dwt(data[..., low:high], self.wavelet, mode=self.mode, axis=-1)
+
+        features = self.baseline.copy()
+        features[..., first:last] = ca[..., first - low // 2:last - low // 2]
+
+        return features
+
+
+
+class IncrementalWelch:
+    """
+    Power spectral density (as in extract_psd with the Welch method) of a dataset and of its perturbed versions. The
+    periodograms of the windows of the original dataset are computed once: when a segment of the signals is modified,
+    only the periodograms of the windows overlapping the segment are computed again and the average is updated
+    """
+
+    def __init__(self, dataset, fs=250, nperseg=256, noverlap=None):
+        """
+        :param dataset: original dataset (n.trials x n.channels x n.samples)
+        :param fs: sampling frequency of the data
+        :param nperseg: length of the windows
+        :param noverlap: number of overlapping samples between windows (None for nperseg / 2)
+        """
+
+        n_samples = dataset.shape[-1]
+        self.nperseg = min(nperseg, n_samples)
+        noverlap = self.nperseg // 2 if noverlap is None else noverlap
+
+        self.dtype = dataset.dtype
+        self.starts = np.arange(0, n_samples - self.nperseg + 1, self.nperseg - noverlap)
+
+        # Hann window and density scaling, as in scipy.signal.welch
+
+        self.window = signal.get_window('hann', self.nperseg)
+        self.scale = 1.0 / (fs * np.sum(self.window ** 2))
+
+        self.periodograms = self.window_periodograms(dataset, self.starts)
+        self.total = self.periodograms.sum(axis=-2)
+
+    def window_periodograms(self, data, starts):
+        """
+        :param data: dataset (n.trials x n.channels x n.samples)
+        :param starts: first sample of each window
+        :return: one-sided periodograms of the windows (n.trials x n.channels x n.windows x n.bins)
+        """
+
+        segments = data[..., starts[:, np.newaxis] + np.arange(self.nperseg)]
+        segments = (segments - segments.mean(axis=-1, keepdims=True)) * self.window
+
+        periodograms = np.abs(np.fft.rfft(segments, axis=-1)) ** 2 * self.scale
+        periodograms[..., 1:(self.nperseg + 1) // 2] *= 2
+
+        return periodograms
+
+    def __call__(self, data, start, end):
+        """
+        :param data: perturbed dataset, equal to the original one except for the samples from start to end
+        :param start: first modified sample
+        :param end: last modified sample (excluded)
+        :return: power spectral density of the perturbed dataset
+        """
+
+        affected = np.flatnonzero((self.starts < end) & (self.starts + self.nperseg > start))
+
+        total = self.total - self.periodograms[..., affected, :].sum(axis=-2)
+        total += self.window_periodograms(data, self.starts[affected]).sum(axis=-2)
+
+        return (total / len(self.starts)).astype(self.dtype)
+
+
+
+class IncrementalStatistics:
+    """
+    Statistical characteristics (as in extract_statistical_characteristics) of a dataset and of its perturbed versions.
+    The additive statistics of the original dataset are computed once: when a segment of the signals is modified, the
+    contribution of the original segment is replaced by the one of the new segment
+    """
+
+    def __init__(self, dataset):
+        """
+        :param dataset: original dataset (n.trials x n.channels x n.samples)
+        """
+
+        self.dataset = np.asarray(dataset)
+        self.shift = np.mean(self.dataset, axis=2, dtype=np.float64)
+        self.sums = statistical_sums(self.dataset, self.shift)
+
+        # Running maximum and minimum from the start and from the end of the signals, for the peak-to-peak of the
+        # samples outside the modified segment
+
+        self.prefix_max = np.maximum.accumulate(self.dataset, axis=2)
+        self.prefix_min = np.minimum.accumulate(self.dataset, axis=2)
+        self.suffix_max = np.maximum.accumulate(self.dataset[:, :, ::-1], axis=2)[:, :, ::-1]
+        self.suffix_min = np.minimum.accumulate(self.dataset[:, :, ::-1], axis=2)[:, :, ::-1]
+
+    def __call__(self, data, start, end):
+        """
+        :param data: perturbed dataset, equal to the original one except for the samples from start to end
+        :param start: first modified sample
+        :param end: last modified sample (excluded)
+        :return: statistical characteristics of the perturbed dataset
+        """
+
+        # When the whole signals are modified nothing can be reused: removing all the original contribution from the
+        # sums would only leave its rounding errors (e.g. a non-zero variance of zeroed signals)
+
+        if start == 0 and end == self.dataset.shape[2]:
+            return extract_statistical_characteristics(data)
+
+        old = statistical_sums(self.dataset[:, :, start:end], self.shift)
+        new = statistical_sums(data[:, :, start:end], self.shift)
+        sums = {name: self.sums[name] - old[name] + new[name] for name in self.sums}
+
+        maximum = np.max(data[:, :, start:end], axis=2)
+        minimum = np.min(data[:, :, start:end], axis=2)
+
+        if start > 0:
+            maximum = np.maximum(maximum, self.prefix_max[:, :, start - 1])
+            minimum = np.minimum(minimum, self.prefix_min[:, :, start - 1])
+        if end < self.dataset.shape[2]:
+            maximum = np.maximum(maximum, self.suffix_max[:, :, end])
+            minimum = np.minimum(minimum, self.suffix_min[:, :, end])
+
+        return statistical_characteristics_from_sums(sums, self.shift, self.dataset.shape[2], maximum, minimum,
+                                                     data[:, :, 0] + data[:, :, -1], dtype=self.dataset.dtype)
+
+
+def incremental_extractor(dataset, function_features):
+    """
+    :param dataset: original dataset (n.trials x n.channels x n.samples)
+    :param function_features: function for the feature extraction of the dataset (also a functools.partial fixing its
+    keyword arguments)
+    :return: incremental version of the feature extraction for the perturbations of the dataset, None if not available
+    (e.g. for arguments not supported by the incremental versions, as the extension modes of extract_wt not in
+    INCREMENTAL_WAVELET_MODES)
+    """
+
+    if function_features is None:
+        return None
+
+    function, keywords = unwrap_extractor(function_features)
+
+    if keywords is None:
+        return None
+
+    if function is extract_wt and set(keywords) <= {'wavelet', 'level', 'mode'} and keywords.get('level', 1) == 1 and \
+            keywords.get('mode', 'symmetric') in INCREMENTAL_WAVELET_MODES:
+        # The coefficients of the original dataset are computed by function_features (that may read them from a
+        # FeatureCache)
+
+        return IncrementalWavelet(dataset, keywords.get('wavelet', 'sym9'), keywords.get('mode', 'symmetric'),
+                                  baseline=function_features(dataset))
+
+    if function is extract_psd and set(keywords) <= {'fs', 'nperseg', 'noverlap', 'method'} and \
+            keywords.get('method', 'welch') == 'welch':
+        return IncrementalWelch(dataset, keywords.get('fs', 250), keywords.get('nperseg', 256),
+                                keywords.get('noverlap'))
+
+    if function is extract_statistical_characteristics and not keywords:
+        return IncrementalStatistics(dataset)
+
+    return None
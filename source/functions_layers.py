@@ -0,0 +1,168 @@
+import numpy as np
+import pywt
+import tensorflow as tf
+
+from functions_cache import unwrap_extractor
+from functions_dataset import extract_wt, extract_psd
+
+
+class CommonAverageReference(tf.keras.layers.Layer):
+    """
+    Keras layer for the common average reference of the channels (axis 1 of the input, as in EEGNet:
+    batch x n.channels x n.samples x 1)
+    """
+
+    def call(self, inputs):
+        return inputs - tf.reduce_mean(inputs, axis=1, keepdims=True)
+
+
+class WaveletApproximation(tf.keras.layers.Layer):
+    """
+    Keras layer for the approximation component of the wavelet decomposition along the samples axis (as extract_wt),
+    implemented as a fixed convolution with stride 2 after the symmetric extension of the signals. The input is
+    batch x n.channels x n.samples x 1 (as in EEGNet) or batch x n.channels x n.samples
+    """
+
+    def __init__(self, wavelet='sym9', **kwargs):
+        """
+        :param wavelet: wavelet used for the decomposition
+        """
+
+        super().__init__(trainable=False, **kwargs)
+        self.wavelet = wavelet
+
+        # Decomposition low-pass filter, reversed since the convolution of tensorflow is a correlation (kept in float64
+        # and converted to the type of the inputs, so that a float64 model uses the exact filter)
+
+        dec_lo = np.array(pywt.Wavelet(wavelet).dec_lo[::-1])
+        self.filter_length = len(dec_lo)
+        self.kernel = tf.constant(dec_lo.reshape((1, -1, 1, 1)), dtype=tf.float64)
+
+    def call(self, inputs):
+        squeeze = inputs.shape.rank == 3
+        if squeeze:
+            inputs = tf.expand_dims(inputs, 3)
+
+        # Extension of filter_length - 1 samples on both sides: coefficient k is computed from the extended samples
+        # 2k + 1 ... 2k + filter_length
+
+        pad = self.filter_length - 1
+        extended = tf.pad(inputs, [[0, 0], [0, 0], [pad, pad], [0, 0]], mode='SYMMETRIC')
+
+        outputs = tf.nn.conv2d(extended[:, :, 1:, :], tf.cast(self.kernel, inputs.dtype), strides=[1, 1, 2, 1],
+                               padding='VALID')
+
+        return tf.squeeze(outputs, 3) if squeeze else outputs
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'wavelet': self.wavelet})
+        return config
+
+
+class PowerSpectrum(tf.keras.layers.Layer):
+    """
+    Keras layer for the power spectral density along the samples axis, with the Welch method (average of the
+    periodograms of overlapping Hann windows, as extract_psd). The input is batch x n.channels x n.samples x 1 (as in
+    EEGNet) or batch x n.channels x n.samples
+    """
+
+    def __init__(self, fs=250, nperseg=256, noverlap=None, **kwargs):
+        """
+        :param fs: sampling frequency of the data
+        :param nperseg: length of the windows (number of frequency bins: nperseg / 2 + 1), reduced to the number of
+        samples for shorter signals (as in scipy.signal.welch)
+        :param noverlap: number of overlapping samples between windows (None for nperseg / 2)
+        """
+
+        super().__init__(trainable=False, **kwargs)
+        self.fs = fs
+        self.nperseg = nperseg
+        self.noverlap = noverlap
+
+    def build(self, input_shape):
+        # Length of the windows, known only with the number of samples of the input
+
+        self.segment_length = min(self.nperseg, input_shape[2])
+        self.segment_overlap = self.segment_length // 2 if self.noverlap is None else self.noverlap
+
+        if self.segment_overlap >= self.segment_length:
+            raise ValueError('noverlap must be less than nperseg')
+
+        window = np.hanning(self.segment_length + 1)[:-1]
+        self.window = tf.constant(window, dtype=tf.float64)
+        scale = 1.0 / (self.fs * np.sum(window ** 2))
+
+        # One-sided spectrum: all the bins except the DC (and the Nyquist one, for even lengths) are doubled
+
+        weights = np.full(self.segment_length // 2 + 1, 2.0)
+        weights[0] = 1
+        if self.segment_length % 2 == 0:
+            weights[-1] = 1
+        self.weights = tf.constant(weights * scale, dtype=tf.float64)
+
+        super().build(input_shape)
+
+    def call(self, inputs):
+        squeeze = inputs.shape.rank == 4
+        if squeeze:
+            inputs = tf.squeeze(inputs, 3)
+
+        frames = tf.signal.frame(inputs, self.segment_length, self.segment_length - self.segment_overlap, axis=-1)
+        frames = (frames - tf.reduce_mean(frames, axis=-1, keepdims=True)) * tf.cast(self.window, inputs.dtype)
+
+        spectra = tf.signal.rfft(frames)
+        periodograms = tf.square(tf.abs(spectra)) * tf.cast(self.weights, inputs.dtype)
+
+        outputs = tf.reduce_mean(periodograms, axis=-2)
+
+        return tf.expand_dims(outputs, 3) if squeeze else outputs
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'fs': self.fs, 'nperseg': self.nperseg, 'noverlap': self.noverlap})
+        return config
+
+
+def feature_layer(function_features, **kwargs):
+    """
+    :param function_features: function for the feature extraction (extract_wt or extract_psd, also a functools.partial
+    fixing their keyword arguments)
+    :param kwargs: other arguments of the layer (e.g. dtype='float64' to keep the precision of extract_wt and
+    extract_psd)
+    :return: Keras layer computing the same features inside the model
+    """
+
+    function, keywords = unwrap_extractor(function_features)
+
+    # The layers implement only the single level decomposition with symmetric extension and the Welch method
+
+    if function is extract_wt and keywords is not None and set(keywords) <= {'wavelet', 'level', 'mode'} and \
+            keywords.get('level', 1) == 1 and keywords.get('mode', 'symmetric') == 'symmetric':
+        return WaveletApproximation(keywords.get('wavelet', 'sym9'), **kwargs)
+
+    if function is extract_psd and keywords is not None and set(keywords) <= {'fs', 'nperseg', 'noverlap', 'method'} \
+            and keywords.get('method', 'welch') == 'welch':
+        return PowerSpectrum(keywords.get('fs', 250), keywords.get('nperseg', 256), keywords.get('noverlap'), **kwargs)
+
+    raise ValueError('No preprocessing layer for {!r}'.format(function_features))
+
+
+def with_preprocessing(model, preprocessing, input_shape):
+    """
+    Function to build a model that applies the preprocessing layers to the raw trials before the given model, so that
+    raw (and perturbed) trials can be evaluated directly
+
+    :param model: model trained on the preprocessed trials (e.g. EEGNet)
+    :param preprocessing: list of preprocessing layers, applied in order
+    :param input_shape: shape of the raw trials (e.g. (n.channels, n.samples, 1))
+    :return: model taking the raw trials as input
+    """
+
+    inputs = tf.keras.Input(shape=input_shape)
+
+    x = inputs
+    for layer in preprocessing:
+        x = layer(x)
+
+    return tf.keras.Model(inputs=inputs, outputs=model(x))
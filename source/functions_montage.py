@@ -0,0 +1,130 @@
+from functools import lru_cache
+
+import numpy as np
+
+# Channels of the BCI competition IV 2a dataset, in the order in which they are saved by dataloading.m
+
+channels_2a = ['Fz', 'FC3', 'FC1', 'FCz', 'FC2', 'FC4', 'C5', 'C3', 'C1', 'Cz', 'C2', 'C4', 'C6', 'CP3', 'CP1', 'CPz',
+               'CP2', 'CP4', 'P1', 'Pz', 'P2', 'POz']
+
+# Neighbours of each channel (indexes start from 1) used for the Laplacian re-referencing
+
+near_channels_2a = {1: [4], 2: [3, 8], 3: [2, 4, 9], 4: [3, 5, 10], 5: [4, 6, 11], 6: [5, 12],
+                    7: [8], 8: [2, 7, 9, 14], 9: [3, 8, 10, 15], 10: [4, 9, 11, 16], 11: [5, 10, 12, 17],
+                    12: [6, 11, 13, 18], 13: [12], 14: [8, 15], 15: [9, 14, 16, 19], 16: [10, 15, 17, 20],
+                    17: [11, 16, 18, 21], 18: [12, 17], 19: [15, 20], 20: [16, 19, 21, 22],
+                    21: [17, 20], 22: [20]}
+
+# Longitudinal (anterior - posterior) bipolar derivations
+
+bipolar_pairs_2a = [('Fz', 'FCz'), ('FC3', 'C3'), ('FC1', 'C1'), ('FCz', 'Cz'), ('FC2', 'C2'), ('FC4', 'C4'),
+                    ('C3', 'CP3'), ('C1', 'CP1'), ('Cz', 'CPz'), ('C2', 'CP2'), ('C4', 'CP4'), ('CP1', 'P1'),
+                    ('CPz', 'Pz'), ('CP2', 'P2'), ('Pz', 'POz')]
+
+# Registered montages: each name is associated to a function that, given the number of channels, returns the
+# (n.derivations x n.channels) spatial filter matrix of the montage
+
+montages = {}
+
+
+def car_matrix(n_channels):
+    """
+    Spatial filter matrix of the common average reference
+
+    :param n_channels: number of channels
+    :return: (n.channels x n.channels) matrix subtracting the mean of all channels from each channel
+    """
+
+    return np.eye(n_channels) - np.full((n_channels, n_channels), 1 / n_channels)
+
+
+def laplacian_matrix(near_channels, n_channels):
+    """
+    Spatial filter matrix of the Laplacian re-referencing
+
+    :param near_channels: dictionary {channel: list of neighbours} (indexes start from 1)
+    :param n_channels: number of channels
+    :return: (n.channels x n.channels) matrix subtracting the mean of the neighbours from each channel
+    """
+
+    if len(near_channels) != n_channels:
+        raise ValueError('The Laplacian montage is defined for {} channels, not {}'.format(len(near_channels),
+                                                                                          n_channels))
+
+    matrix = np.eye(n_channels)
+
+    for channel, near_channel in near_channels.items():
+        matrix[channel - 1, np.array(near_channel) - 1] -= 1 / len(near_channel)
+
+    return matrix
+
+
+def bipolar_matrix(pairs, channels, n_channels):
+    """
+    Spatial filter matrix of a bipolar montage
+
+    :param pairs: list of (channel, reference) names, one for each derivation
+    :param channels: names of the channels, in the order in which they are saved
+    :param n_channels: number of channels
+    :return: (n.derivations x n.channels) matrix computing the difference of each pair
+    """
+
+    if len(channels) != n_channels:
+        raise ValueError('The bipolar montage is defined for {} channels, not {}'.format(len(channels), n_channels))
+
+    matrix = np.zeros((len(pairs), n_channels))
+
+    for i, (channel, reference) in enumerate(pairs):
+        matrix[i, channels.index(channel)] = 1
+        matrix[i, channels.index(reference)] = -1
+
+    return matrix
+
+
+def register_montage(name, builder):
+    """
+    Function to register a new montage (an already existing one with the same name is replaced)
+
+    :param name: name of the montage, to be used as channel_elaboration in load_dataset
+    :param builder: function that, given the number of channels, returns the spatial filter matrix of the montage
+    """
+
+    montages[name] = builder
+    montage_matrix.cache_clear()
+
+
+@lru_cache(maxsize=None)
+def montage_matrix(name, n_channels):
+    """
+    Function to retrieve the spatial filter matrix of a registered montage (computed once for each number of channels)
+
+    :param name: name of the montage
+    :param n_channels: number of channels
+    :return: read-only (n.derivations x n.channels) spatial filter matrix
+    """
+
+    if name not in montages:
+        raise ValueError('Unknown montage {}: available montages are {}'.format(name, sorted(montages)))
+
+    matrix = np.array(montages[name](n_channels), dtype=float)
+    matrix.setflags(write=False)
+
+    return matrix
+
+
+def apply_montage(trials, matrix, out=None):
+    """
+    Function to apply a spatial filter matrix to all the trials with a single matrix product
+
+    :param trials: data matrix (n.trials x n.channels x n.samples)
+    :param matrix: spatial filter matrix (n.derivations x n.channels)
+    :param out: optional matrix (n.trials x n.derivations x n.samples) in which the result is written
+    :return: re-referenced data matrix (n.trials x n.derivations x n.samples)
+    """
+
+    return np.matmul(matrix, trials, out=out)
+
+
+register_montage('car', car_matrix)
+register_montage('laplacian', lambda n_channels: laplacian_matrix(near_channels_2a, n_channels))
+register_montage('bipolar', lambda n_channels: bipolar_matrix(bipolar_pairs_2a, channels_2a, n_channels))
@@ -8,7 +8,9 @@ import tensorflow as tf
 
 from utilities.EEGModels import EEGNet
 from matplotlib import pyplot as plt
-from functions_dataset import extract_indexes_segments
+from functions_dataset import extract_indexes_segments, reshape_fbcsp
+from functions_incremental import incremental_extractor
+from functions_cache import uncached
 
 
 def CNN(input_shape):
@@ -116,6 +118,43 @@ def training_EEGNet(train_data, train_labels, batch_size, num_epochs, model_path
     return model
 
 
+def training_EEGNet_streaming(train_set, batch_size, num_epochs, model_path, function_features=None,
+                              necessary_redimension=False):
+    """
+    Function for the training of an EEGNet reading the training dataset one batch at a time (instead of loading it
+    in memory as in training_EEGNet). The trained model is then saved and loss and accuracy are plotted.
+
+    :param train_set: training dataset (TrialDataset)
+    :param batch_size: batch size for training
+    :param num_epochs: number of epochs for training
+    :param model_path: path and model name
+    :param function_features: function for the feature extraction of each batch (None to use the signal)
+    :param necessary_redimension: boolean to indicate if redimension is necessary
+    :return: trained model
+    """
+
+    train_set, val_set = train_set.split(train_size=0.8)
+
+    sample = train_set[:1][0]
+    if function_features is not None:
+        sample = function_features(sample)
+
+    model = EEGNet(nb_classes=2, Chans=sample.shape[1], Samples=sample.shape[2])
+    model.compile(loss='categorical_crossentropy', optimizer="adam", metrics=['accuracy'])
+
+    train_data = train_set.to_tf_dataset(batch_size, shuffle=True, function_features=function_features,
+                                         necessary_redimension=necessary_redimension)
+    val_data = val_set.to_tf_dataset(batch_size, function_features=function_features,
+                                     necessary_redimension=necessary_redimension)
+
+    history = model.fit(train_data, validation_data=val_data, epochs=num_epochs, verbose=2)
+
+    plot_model_training(history, model_path)
+    model.save('{}.h5'.format(model_path))
+
+    return model
+
+
 def plot_model_training(history, model_name):
     """
     Plot of loss and accuracy in training and validation tests during the training of a model
@@ -145,7 +184,8 @@ def plot_model_training(history, model_name):
     plt.close()
 
 
-def ablation(dataset, labels, model, function_features=None, n_segments=4, n_channels=22, n_features=396, necessary_redimension=False):
+def ablation(dataset, labels, model, function_features=None, n_segments=4, n_channels=22, n_features=396, necessary_redimension=False,
+             fbcsp=None):
     """
     Function to perform different types of ablation according to the XAI definition
 
@@ -158,6 +198,7 @@ def ablation(dataset, labels, model, function_features=None, n_segments=4, n_cha
     :param n_channels: number of channels to be evaluated with XAI
     :param n_features: number of features to be extracted from FBCSP
     :param necessary_redimension: boolean to indicate if redimension is necessary
+    :param fbcsp: trained FBCSP_V4 object, to compute the features of the channel ablation from the band covariances
     """
 
     print("Applying ablation...")
@@ -166,7 +207,8 @@ def ablation(dataset, labels, model, function_features=None, n_segments=4, n_cha
     interpolation_accuracies = ablation_linear_segments(dataset, labels, model, function_features, n_segments,
                                                         n_features, necessary_redimension)
 
-    channel_accuracies = ablation_zero_channels(dataset, labels, model, function_features, n_channels, n_features, necessary_redimension)
+    channel_accuracies = ablation_zero_channels(dataset, labels, model, function_features, n_channels, n_features, necessary_redimension,
+                                                fbcsp)
 
     return zero_accuracies, interpolation_accuracies, channel_accuracies
 
@@ -191,6 +233,10 @@ def ablation_zero_segments(dataset, labels, model, function_features=None, n_seg
     indexes = extract_indexes_segments(dataset.shape[2], n_segments)
     accuracies = np.empty(n_segments)
 
+    # Features of the original dataset computed once, only the ones depending on the segment are computed again
+
+    incremental = incremental_extractor(dataset, function_features)
+
     for k in range(n_segments):
 
         data = copy.deepcopy(dataset)
@@ -200,11 +246,13 @@ def ablation_zero_segments(dataset, labels, model, function_features=None, n_seg
 
         data[:, :, start:end] = np.zeros((data.shape[0], data.shape[1], end - start))
 
-        if function_features is not None:
+        if incremental is not None:
+            x = incremental(data, start, end)
+        elif function_features is not None:
             if function_features.__name__ == "extractFBCSP":
                 x = function_features(dataset, labels, n_features)
             else:
-                x = function_features(data)
+                x = uncached(function_features)(data)
         else:
             x = data
 
@@ -238,6 +286,10 @@ def ablation_linear_segments(dataset, labels, model, function_features=None, n_s
     indexes = extract_indexes_segments(dataset.shape[2], n_segments)
     accuracies = np.empty(n_segments)
 
+    # Features of the original dataset computed once, only the ones depending on the segment are computed again
+
+    incremental = incremental_extractor(dataset, function_features)
+
     for k in range(n_segments):
 
         data = copy.deepcopy(dataset)
@@ -255,11 +307,13 @@ def ablation_linear_segments(dataset, labels, model, function_features=None, n_s
                 lin = np.linspace(prev, cons, num=lin_len)
                 data[j, i, start:end] = lin
 
-        if function_features is not None:
+        if incremental is not None:
+            x = incremental(data, start, end)
+        elif function_features is not None:
             if function_features.__name__ == "extractFBCSP":
                 x = function_features(dataset, labels, n_features)
             else:
-                x = function_features(data)
+                x = uncached(function_features)(data)
         else:
             x = data
 
@@ -272,7 +326,8 @@ def ablation_linear_segments(dataset, labels, model, function_features=None, n_s
     return accuracies
 
 
-def ablation_zero_channels(dataset, labels, model, function_features=None, n_channels=22, n_features=396, necessary_redimension=False):
+def ablation_zero_channels(dataset, labels, model, function_features=None, n_channels=22, n_features=396, necessary_redimension=False,
+                           fbcsp=None):
     """
     Function to perform ablation setting the signal from the channel under investigation at zero
 
@@ -284,26 +339,35 @@ def ablation_zero_channels(dataset, labels, model, function_features=None, n_cha
     :param n_channels: number of channels to be evaluated with XAI
     :param n_features: number of features to be extracted with FBCSP
     :param necessary_redimension: boolean to indicate if redimension is necessary
+    :param fbcsp: trained FBCSP_V4 object: if given, the FBCSP features of the dataset without each channel are computed
+    from the band covariances of the dataset (filtered only once) instead of function_features
     :return: each value of the array represents the accuracy obtained without the corresponding segment
     """
 
     accuracies = np.empty(n_channels)
 
+    if fbcsp is not None:
+        fbcsp.cacheTrials(dataset, keep_signals=False)
+
     for k in range(n_channels):
 
-        data = copy.deepcopy(dataset)
+        if fbcsp is not None:
+            x = reshape_fbcsp(fbcsp.channelAblationFeatures(k), n_features)
 
-        # Set the channel values of zero and rebuild the dataset
+        else:
+            data = copy.deepcopy(dataset)
 
-        data[:, k, :] = np.zeros((data.shape[0], data.shape[2]))
+            # Set the channel values of zero and rebuild the dataset
 
-        if function_features is not None:
-            if function_features.__name__ == "extractFBCSP":
-                x = function_features(dataset, labels, n_features)
+            data[:, k, :] = np.zeros((data.shape[0], data.shape[2]))
+
+            if function_features is not None:
+                if function_features.__name__ == "extractFBCSP":
+                    x = function_features(dataset, labels, n_features)
+                else:
+                    x = uncached(function_features)(data)
             else:
-                x = function_features(data)
-        else:
-            x = data
+                x = data
 
         # Evaluate the difference of accuracies
         if necessary_redimension:
@@ -314,7 +378,8 @@ def ablation_zero_channels(dataset, labels, model, function_features=None, n_cha
     return accuracies
 
 
-def permutation(dataset, labels, model, function_features=None, n_segments=4, n_channels=22, n_features=396, necessary_redimension=False):
+def permutation(dataset, labels, model, function_features=None, n_segments=4, n_channels=22, n_features=396, necessary_redimension=False,
+                fbcsp=None):
     """
     Function to perform different types of permutation according to the XAI definition
 
@@ -327,12 +392,14 @@ def permutation(dataset, labels, model, function_features=None, n_segments=4, n_
     :param n_channels: number of channels to be evaluated with XAI
     :param n_features: number of features to be extracted with FBCSP
     :param necessary_redimension: boolean to indicate if redimension is necessary
+    :param fbcsp: trained FBCSP_V4 object, to compute the features of the channel permutation from the band covariances
     """
 
     print("Applying permutation...")
     accuracies_segments = permutation_segments(dataset, labels, model, function_features, n_segments, n_features, necessary_redimension)
 
-    accuracies_channels = permutation_channels(dataset, labels, model, function_features, n_channels, n_features, necessary_redimension)
+    accuracies_channels = permutation_channels(dataset, labels, model, function_features, n_channels, n_features, necessary_redimension,
+                                               fbcsp)
 
     return accuracies_segments, accuracies_channels
 
@@ -358,6 +425,10 @@ def permutation_segments(dataset, labels, model, function_features=None, n_segme
     indexes = extract_indexes_segments(dataset.shape[2], n_segments)
     accuracies = np.empty(n_segments)
 
+    # Features of the original dataset computed once, only the ones depending on the segment are computed again
+
+    incremental = incremental_extractor(dataset, function_features)
+
     for k in range(n_segments):
 
         data = copy.deepcopy(dataset)
@@ -376,11 +447,13 @@ def permutation_segments(dataset, labels, model, function_features=None, n_segme
                 # q = np.random.choice(actual_channels)
                 data[i, j, start:end] = data[p, j, start:end]
 
-        if function_features is not None:
+        if incremental is not None:
+            x = incremental(data, start, end)
+        elif function_features is not None:
             if function_features.__name__ == "extractFBCSP":
                 x = function_features(dataset, labels, n_features)
             else:
-                x = function_features(data)
+                x = uncached(function_features)(data)
         else:
             x = data
 
@@ -394,7 +467,8 @@ def permutation_segments(dataset, labels, model, function_features=None, n_segme
     return accuracies
 
 
-def permutation_channels(dataset, labels, model, function_features=None, n_channels=22, n_features=396, necessary_redimension=False):
+def permutation_channels(dataset, labels, model, function_features=None, n_channels=22, n_features=396, necessary_redimension=False,
+                         fbcsp=None):
     """
     Function to perform permutation substituting a channel with the same channel of another trial
 
@@ -406,30 +480,45 @@ def permutation_channels(dataset, labels, model, function_features=None, n_chann
     :param n_channels: number of channels to be evaluated with XAI
     :param n_features: number of features to be extracted with FBCSP
     :param necessary_redimension: boolean to indicate if redimension is necessary
+    :param fbcsp: trained FBCSP_V4 object: if given, the FBCSP features of the permuted datasets are computed from the
+    band covariances and the filtered signals of the dataset (filtered only once) instead of function_features
     :return: each value of the array represents the accuracy obtained without the corresponding segment
     """
 
     accuracies = np.empty(n_channels)
 
+    if fbcsp is not None:
+        fbcsp.cacheTrials(dataset)
+
     for k in range(n_channels):
 
-        data = copy.deepcopy(dataset)
-        list_trials = range(data.shape[0])
+        list_trials = range(dataset.shape[0])
 
-        # Select the random new trial, substitute the channel and rebuild the dataset
+        # Select the random new trial of each trial. The channels are substituted in order, so a trial taking the
+        # channel from a previous trial receives the channel already substituted in that trial
 
-        for i in range(data.shape[0]):
+        donors = np.empty(dataset.shape[0], dtype=int)
+        for i in range(dataset.shape[0]):
             actual_trials = [t for t in list_trials if t != i]
             p = np.random.choice(actual_trials)
-            data[i, k, :] = data[p, k, :]
+            donors[i] = donors[p] if p < i else p
+
+        if fbcsp is not None:
+            x = reshape_fbcsp(fbcsp.channelPermutationFeatures(k, donors), n_features)
 
-        if function_features is not None:
-            if function_features.__name__ == "extractFBCSP":
-                x = function_features(dataset, labels, n_features)
-            else:
-                x = function_features(data)
         else:
-            x = data
+            # Substitute the channel and rebuild the dataset
+
+            data = copy.deepcopy(dataset)
+            data[:, k, :] = dataset[donors, k, :]
+
+            if function_features is not None:
+                if function_features.__name__ == "extractFBCSP":
+                    x = function_features(dataset, labels, n_features)
+                else:
+                    x = uncached(function_features)(data)
+            else:
+                x = data
 
         # Evaluate the difference of accuracies
         if necessary_redimension:
@@ -0,0 +1,196 @@
+import os
+
+import h5py
+import numpy as np
+
+
+def is_store(path):
+    """
+    :param path: path of a directory of .mat files or of an HDF5 store
+    :return: True if the path is an HDF5 store written by dataloading.py
+    """
+
+    return os.path.isfile(path) and os.path.splitext(path)[1] in ['.h5', '.hdf5']
+
+
+def fill_missing_linear(data):
+    """
+    Function to replace in place the NaN values of each channel by linear interpolation of the neighbouring values
+    (and linear extrapolation at the extremities), as done by fillmissing(data, 'linear') in Matlab
+
+    :param data: signal (n.samples x n.channels)
+    :return: the same signal without NaN values
+    """
+
+    samples = np.arange(data.shape[0])
+
+    for channel in range(data.shape[1]):
+        missing = np.isnan(data[:, channel])
+        if not missing.any():
+            continue
+
+        valid = np.flatnonzero(~missing)
+        data[missing, channel] = np.interp(samples[missing], valid, data[valid, channel])
+
+        # np.interp keeps the extremities constant: they are extrapolated with the first and last valid segments
+
+        if len(valid) > 1:
+            for before, first, second in [(samples < valid[0], valid[0], valid[1]),
+                                          (samples > valid[-1], valid[-1], valid[-2])]:
+                slope = (data[second, channel] - data[first, channel]) / (second - first)
+                data[before, channel] = data[first, channel] + slope * (samples[before] - first)
+
+    return data
+
+
+def read_gdf(path, n_channels=22):
+    """
+    Function to read a GDF file of the BCI competition IV 2a dataset and extract the EEG signal and the events of the
+    motor imagery runs, with the same elaboration of dataloading.m (Biosig)
+
+    :param path: path of the GDF file (e.g. A01T.gdf)
+    :param n_channels: number of EEG channels (the following ones are EOG)
+    :return: signal (n.samples x n.channels, in uV) and event matrix (position, type and duration of each event)
+    """
+
+    import mne
+
+    raw = mne.io.read_raw_gdf(path, preload=True, verbose='ERROR')
+    fs = raw.info['sfreq']
+
+    s = raw.get_data()[:n_channels].T * 1e6
+
+    # Events: positions are expressed starting from 1 as in Biosig
+
+    event_type = np.array([int(float(description)) for description in raw.annotations.description])
+    event_pos = np.round(raw.annotations.onset * fs).astype(int) + 1
+    event_duration = np.round(raw.annotations.duration * fs).astype(int)
+
+    # Start of the various runs (the first three are the EOG calibration)
+
+    runs_idx = event_pos[event_type == 32766][3:]
+    start_point = runs_idx[0]
+
+    data = s[start_point - 1:, :]
+
+    # Shift indices (caused by removing initial part)
+
+    runs_idx = runs_idx - start_point + 1
+    event_pos = event_pos - start_point
+    event_type = event_type[event_pos >= 0]
+    event_duration = event_duration[event_pos >= 0]
+    event_pos = event_pos[event_pos >= 0]
+
+    # Remove the NaN that indicate the start of the runs
+
+    for run in runs_idx:
+        data = np.delete(data, np.arange(run - 1, run + 100), axis=0)
+        event_pos[event_pos >= run] -= 100
+
+    # Remove unwanted NaN
+
+    data = fill_missing_linear(data)
+
+    event_matrix = np.stack((event_pos, event_type, event_duration), axis=1)
+
+    return data, event_matrix
+
+
+def write_store_subject(store_path, subject, data, event_matrix, trial_start, trial_labels, trial_artefacts, fs=250,
+                        trial_seconds=7):
+    """
+    Function to save the data of a subject in the HDF5 store (an already existing group of the subject is replaced).
+    The continuous signal is saved in compressed chunks of a few seconds, the trials are saved one for each chunk so
+    that any subset of trials (e.g. a class) can be read without reading the others
+
+    :param store_path: path of the HDF5 store
+    :param subject: index of the subject
+    :param data: continuous signal (n.samples x n.channels)
+    :param event_matrix: event matrix (position, type and duration of each event)
+    :param trial_start: sample at which each trial starts
+    :param trial_labels: label of each trial (769 for left hand, 770 for right hand)
+    :param trial_artefacts: True for the trials labeled as artefacts
+    :param fs: sampling frequency of the signal
+    :param trial_seconds: length (in seconds) of the raw trials, from their start
+    """
+
+    n_samples = int(trial_seconds * fs)
+    trials = np.take(data.T, np.asarray(trial_start)[:, np.newaxis] + np.arange(n_samples), axis=1)
+
+    with h5py.File(store_path, 'a') as f:
+        name = 'S{}'.format(subject)
+        if name in f:
+            del f[name]
+
+        group = f.create_group(name)
+        group.attrs['fs'] = fs
+
+        group.create_dataset('data', data=data, chunks=(min(len(data), 4 * fs), data.shape[1]), compression='gzip',
+                             shuffle=True)
+        group.create_dataset('event_matrix', data=event_matrix)
+
+        group.create_dataset('trials', data=trials.transpose(1, 0, 2), chunks=(1, data.shape[1], n_samples),
+                             compression='gzip', shuffle=True)
+        group.create_dataset('trial_start', data=trial_start)
+        group.create_dataset('trial_labels', data=trial_labels)
+        group.create_dataset('trial_artefacts', data=np.asarray(trial_artefacts, dtype=bool))
+
+
+def read_store_subject(store_path, subject):
+    """
+    :param store_path: path of the HDF5 store
+    :param subject: index of the subject
+    :return: continuous signal (n.samples x n.channels) and event matrix of the subject
+    """
+
+    with h5py.File(store_path, 'r') as f:
+        group = f['S{}'.format(subject)]
+        return group['data'][()], group['event_matrix'][()]
+
+
+def read_store_events(store_path, subject):
+    """
+    :param store_path: path of the HDF5 store
+    :param subject: index of the subject
+    :return: event matrix of the subject (without reading its signal)
+    """
+
+    with h5py.File(store_path, 'r') as f:
+        return f['S{}'.format(subject)]['event_matrix'][()]
+
+
+def store_data_shape(store_path, subject):
+    """
+    :param store_path: path of the HDF5 store
+    :param subject: index of the subject
+    :return: shape of the continuous signal of the subject (without reading it)
+    """
+
+    with h5py.File(store_path, 'r') as f:
+        return f['S{}'.format(subject)]['data'].shape
+
+
+def read_store_trials(store_path, subject, label=None, consider_artefacts=True):
+    """
+    Function to read the raw trials of a subject, reading only the chunks of the selected trials
+
+    :param store_path: path of the HDF5 store
+    :param subject: index of the subject
+    :param label: label of the trials to be read (769 for left hand, 770 for right hand, None for both)
+    :param consider_artefacts: True if trials labeled as artefacts in the dataset are considered, False otherwise
+    :return: raw trials (n.trials x n.channels x n.samples) and relative labels
+    """
+
+    with h5py.File(store_path, 'r') as f:
+        group = f['S{}'.format(subject)]
+        labels = group['trial_labels'][()]
+
+        selected = np.ones(len(labels), dtype=bool)
+        if label is not None:
+            selected &= labels == label
+        if not consider_artefacts:
+            selected &= ~group['trial_artefacts'][()]
+
+        indexes = np.flatnonzero(selected)
+
+        return group['trials'][indexes], labels[indexes]
@@ -0,0 +1,261 @@
+import functools
+
+import numpy as np
+from sklearn.model_selection import train_test_split
+
+from functions_cache import stored_features
+from functions_dataset import load_cached_subject, cache_subjects, dataset_cache_key, extract_features_chunked
+from trial_index import TrialIndex
+
+
+class TrialDataset:
+    """
+    Dataset of trials kept on disk: the trials of each subject are read from their memory-mapped array only when
+    requested, so that subsets, classes and batches can be extracted without loading the whole dataset in memory
+    """
+
+    def __init__(self, trials_list, labels_list, indexes=None, dtype=None, trial_index=None, key=None, sources=()):
+        """
+        :param trials_list: list of the trials matrices of each subject (n.trials x n.channels x n.samples), usually
+        read-only memory maps
+        :param labels_list: list of the labels of each subject (n.trials x 2)
+        :param indexes: global indexes (over the concatenation of the subjects) of the trials in the dataset (None to
+        consider all of them)
+        :param dtype: data type of the trials returned by the dataset (None to keep the one of the stored trials)
+        :param trial_index: TrialIndex of all the trials (over the concatenation of the subjects), None if not available
+        :param key: key identifying all the trials (see dataset_cache_key), needed to save the features in the store
+        :param sources: files from which the trials are derived
+        """
+
+        self.trials_list = trials_list
+        self.dtype = np.dtype(trials_list[0].dtype if dtype is None else dtype)
+        self.labels_list = labels_list
+        self.offsets = np.cumsum([0] + [len(trials) for trials in trials_list])
+
+        if indexes is None:
+            indexes = np.arange(self.offsets[-1])
+        self.indexes = np.asarray(indexes, dtype=np.int64)
+
+        # Labels are small: they are kept in memory for the whole dataset
+
+        self.all_labels = np.concatenate([np.asarray(labels) for labels in labels_list], axis=0)
+        self.trial_index = trial_index
+        self.key = key
+        self.sources = sources
+
+    @classmethod
+    def from_cache(cls, data_dir, subjects, cache_dir, n_jobs=None, **params):
+        """
+        Build the dataset from the trials cache of load_dataset, elaborating the subjects not yet in the cache (in
+        parallel, as load_subjects). Trials saved with a lower precision (storage_dtype) are converted to dtype batch by
+        batch, when they are read
+
+        :param data_dir: directory where data are saved
+        :param subjects: indexes of the subjects
+        :param cache_dir: directory of the trials cache
+        :param n_jobs: number of processes elaborating the missing subjects (None to use all the processors)
+        :param params: other parameters of load_dataset (fs, start_second, signal_length, consider_artefacts,
+        channel_elaboration, dtype, storage_dtype)
+        :return: dataset of all the trials of the subjects
+        """
+
+        cache_subjects(data_dir, subjects, cache_dir, n_jobs=n_jobs, **params)
+
+        trials_list, labels_list, index_list = [], [], []
+
+        for subject in subjects:
+            cached = load_cached_subject(data_dir, subject, cache_dir, **params)
+
+            trials_list.append(cached[0])
+            labels_list.append(cached[1])
+            index_list.append(cached[2])
+
+        key, sources = dataset_cache_key(data_dir, subjects, **params)
+
+        return cls(trials_list, labels_list, dtype=params.get('dtype', np.float64),
+                   trial_index=TrialIndex.concatenate(index_list), key=key, sources=sources)
+
+    def __len__(self):
+        return len(self.indexes)
+
+    @property
+    def shape(self):
+        return (len(self),) + self.trials_list[0].shape[1:]
+
+    @property
+    def labels(self):
+        return self.all_labels[self.indexes]
+
+    @property
+    def index(self):
+        """
+        :return: TrialIndex of the trials in the dataset
+        """
+
+        if self.trial_index is None:
+            raise ValueError('The dataset has no trial index')
+
+        return self.trial_index[self.indexes]
+
+    def __getitem__(self, item):
+        """
+        Read the requested trials (position inside the dataset: integer, slice or array of positions)
+
+        :return: matrix of the trials (n.trials x n.channels x n.samples) and relative labels (n.trials x 2)
+        """
+
+        if isinstance(item, (int, np.integer)):
+            trials, labels = self[np.array([item])]
+            return trials[0], labels[0]
+
+        indexes = self.indexes[item]
+        trials = np.empty((len(indexes),) + self.trials_list[0].shape[1:], dtype=self.dtype)
+
+        # Read the trials subject by subject, in increasing order to access the files sequentially
+
+        subjects = np.searchsorted(self.offsets, indexes, side='right') - 1
+
+        for s in np.unique(subjects):
+            positions = np.flatnonzero(subjects == s)
+            local = indexes[positions] - self.offsets[s]
+            order = np.argsort(local)
+            trials[positions[order]] = self.trials_list[s][local[order]]
+
+        return trials, self.all_labels[indexes]
+
+    def subset(self, positions):
+        """
+        :param positions: positions (inside the current dataset) of the trials to be kept
+        :return: dataset of the selected trials (no trial is read)
+        """
+
+        return TrialDataset(self.trials_list, self.labels_list, self.indexes[positions], self.dtype, self.trial_index,
+                            self.key, self.sources)
+
+    def select(self, **query):
+        """
+        :param query: conditions on the columns of the trial index (subject, run, label, artefact), as in
+        TrialIndex.select
+        :return: dataset of the trials satisfying the conditions (no trial is read)
+        """
+
+        return self.subset(self.index.select(**query))
+
+    def filter_class(self, label):
+        """
+        :param label: label of the class, integer (0 for left hand, 1 for right hand) or one-hot ([1, 0] for left hand,
+        [0, 1] for right hand)
+        :return: dataset of the trials of the class (no trial is read)
+        """
+
+        label = np.asarray(label)
+        if label.ndim > 0:
+            label = np.argmax(label)
+
+        if self.trial_index is None:
+            return self.subset(np.flatnonzero(np.argmax(self.labels, axis=1) == label))
+
+        return self.select(label=label)
+
+    def split(self, train_size=0.8, random_state=None):
+        """
+        :param train_size: proportion of the trials in the first dataset
+        :param random_state: seed of the random split
+        :return: two datasets with a random partition of the trials (no trial is read)
+        """
+
+        first, second = train_test_split(np.arange(len(self)), train_size=train_size, random_state=random_state)
+
+        return self.subset(first), self.subset(second)
+
+    def to_array(self):
+        """
+        :return: matrix of all the trials in the dataset and relative labels (the whole dataset is loaded in memory)
+        """
+
+        return self[:]
+
+    def features(self, function_features, store_dir, *args, chunk_size=64, **params):
+        """
+        Features of the trials in the dataset, read from the feature store if they have already been computed for the
+        same trials (the trials are read only if the features are computed)
+
+        :param function_features: function for the feature extraction
+        :param store_dir: directory of the feature store
+        :param args: other positional arguments of function_features
+        :param chunk_size: number of trials read at a time when the features are computed (only for the functions
+        elaborating each trial independently, i.e. without args; None to read all the trials at once)
+        :param params: keyword arguments of function_features
+        :return: matrix of the features (read-only memory map)
+        """
+
+        if self.key is None:
+            raise ValueError('The dataset has no key: build it with from_cache to use the feature store')
+
+        if chunk_size is None or args:
+            return stored_features(store_dir, function_features, self.key, self.indexes, lambda: self.to_array()[0],
+                                   *args, sources=self.sources, **params)
+
+        # Features computed a chunk of trials at a time (the whole dataset is never loaded in memory), with the same
+        # name of function_features in the store
+
+        @functools.wraps(function_features)
+        def chunked(dataset, **chunked_params):
+            return extract_features_chunked(function_features, dataset, chunk_size=chunk_size, **chunked_params)
+
+        return stored_features(store_dir, chunked, self.key, self.indexes, self, sources=self.sources, **params)
+
+    def batches(self, batch_size=16, shuffle=False, seed=None, function_features=None):
+        """
+        Iterate through the dataset reading one batch at a time
+
+        :param batch_size: number of trials in each batch
+        :param shuffle: True to iterate in random order
+        :param seed: seed of the random order
+        :param function_features: optional function for the feature extraction of each batch
+        :return: generator of (trials, labels) batches
+        """
+
+        positions = np.arange(len(self))
+        if shuffle:
+            np.random.default_rng(seed).shuffle(positions)
+
+        for start in range(0, len(positions), batch_size):
+            trials, labels = self[positions[start:start + batch_size]]
+
+            if function_features is not None:
+                trials = function_features(trials)
+
+            yield trials, labels
+
+    def to_tf_dataset(self, batch_size=16, shuffle=False, function_features=None, necessary_redimension=False):
+        """
+        Adapter to tf.data, to train and evaluate keras models reading one batch at a time
+
+        :param batch_size: number of trials in each batch
+        :param shuffle: True to iterate in a different random order at each epoch
+        :param function_features: optional function for the feature extraction of each batch
+        :param necessary_redimension: True to add the last dimension required by the convolutional networks
+        :return: tf.data.Dataset of (trials, labels) batches
+        """
+
+        import tensorflow as tf
+
+        def generator():
+            for trials, labels in self.batches(batch_size, shuffle, None, function_features):
+                if necessary_redimension:
+                    trials = np.expand_dims(trials, 3)
+                yield trials.astype(np.float32, copy=False), labels.astype(np.float32)
+
+        # The shape of the elements is retrieved from the first trial
+
+        sample = self[:1][0]
+        if function_features is not None:
+            sample = function_features(sample)
+        if necessary_redimension:
+            sample = np.expand_dims(sample, 3)
+
+        signature = (tf.TensorSpec(shape=(None,) + sample.shape[1:], dtype=tf.float32),
+                     tf.TensorSpec(shape=(None, self.all_labels.shape[1]), dtype=tf.float32))
+
+        return tf.data.Dataset.from_generator(generator, output_signature=signature).prefetch(2)
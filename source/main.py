@@ -1,6 +1,9 @@
 from functions_dataset import *
 from functions_network import *
 from variability_analysis import *
+from lazy_dataset import TrialDataset
+from functions_cache import FeatureCache
+from functions_layers import feature_layer, with_preprocessing
 from sklearn.model_selection import train_test_split
 import tensorflow as tf
 import numpy as np
@@ -8,13 +11,21 @@ import numpy as np
 if __name__ == "__main__":
 
     data_folder = '../dataset/EEG'
+    cache_folder = '../dataset/cache'     # elaborated trials are saved here and reused by the following runs
+    features_folder = None      # folder where the features of the test sets are saved and reused by the following
+                                # runs (e.g. '../dataset/cache/features', about 20 MB per iteration), None to disable
     output_folder = '../output/variability - 4 segments - 1000 iterations - CAR'
 
     n_segments = 4          # number of segments considered in the signal
     iterations = 1000       # number of iterations of the training for the variability analysis
     eegnet = True           # if perform eegnet training or cnn training
     wavelet = True          # if use the wavelet transform or not
+    in_graph_features = False   # if compute the features inside the model (raw trials are given to the model)
     channel_elaboration = 'car'
+    precision = np.float64      # data type of the trials in the whole pipeline (np.float32 to halve the memory, to be
+                                # validated with benchmarks.check_precision before use)
+    storage_precision = None    # data type of the trials saved in the cache (None to save them with precision, e.g.
+                                # np.float16 to reduce the size of the cache)
     
     print(output_folder)
 
@@ -37,20 +48,15 @@ if __name__ == "__main__":
     # sys.stdout = open("../output/output - {} segments.txt".format(n_segments), "w")  # TO WRITE ALL OUTPUT IN A FILE
 
     subjects = range(1, 10, 1)  # dataset composition
-    dataset, labels = None, None
 
-    # For each subject, extract the dataset
-    for subject in subjects:
+    # Dataset of all the subjects: trials are kept on disk (memory-mapped) and read only when needed
+    dataset = TrialDataset.from_cache(data_folder, subjects, cache_folder, consider_artefacts=False,
+                                      channel_elaboration=channel_elaboration, dtype=precision,
+                                      storage_dtype=storage_precision)
 
-        if dataset is None:
-            dataset, labels = load_dataset(data_folder, subject, consider_artefacts=False, channel_elaboration=channel_elaboration)
-
-        else:
-            d, l = load_dataset(data_folder, subject, consider_artefacts=False, channel_elaboration=channel_elaboration)
-            dataset = np.concatenate((dataset, np.array(d)), axis=0)  # complete dataset
-            labels = np.concatenate((labels, np.array(l)), axis=0)
-
-    labels = np.array(labels)
+    # Features of the original (not perturbed) datasets are computed once for each (extractor, dataset) pair and
+    # reused in the same iteration: the perturbed datasets of ablation and permutation bypass the cache
+    features_cache = FeatureCache(max_bytes=2 ** 28)
 
     # Common hyperparameters for the training
     batch_size = 16
@@ -60,26 +66,42 @@ if __name__ == "__main__":
     for i in range(iterations):
         print('\n\tIteration: ', i)
 
-        # Extraction of the different datasets
-        train_dataset, test_dataset, train_labels, test_labels = train_test_split(dataset, labels, train_size=0.8)
+        # Extraction of the different datasets (only the test set is loaded in memory): the split of each iteration is
+        # always the same, so that the stored features can be reused
+        train_set, test_set = dataset.split(train_size=0.8, random_state=i)
+        test_dataset, test_labels = test_set.to_array()
 
         if wavelet:
-            train_dataset_proc = extract_wt(train_dataset)
-            test_dataset_proc = extract_wt(test_dataset)
-            wavelet_variation(train_dataset[0][0])
-            permutation_visualization(train_dataset[0][0], train_dataset[1][0])
+            function = features_cache.wrap(extract_wt)
+            if features_folder is not None:
+                test_dataset_proc = test_set.features(extract_wt, features_folder)
+            else:
+                test_dataset_proc = function(test_dataset)
+            examples = train_set[:2][0]
+            wavelet_variation(examples[0][0])
+            permutation_visualization(examples[0][0], examples[1][0])
         else:
-            train_dataset_proc = train_dataset
+            function = None
             test_dataset_proc = test_dataset
 
         # Network training
         if eegnet:
-            model = training_EEGNet(train_dataset_proc, train_labels, batch_size=batch_size, num_epochs=num_epochs,
-                                    model_path='../models/model', necessary_redimension=necessary_redimension)
+            model = training_EEGNet_streaming(train_set, batch_size=batch_size, num_epochs=num_epochs,
+                                              model_path='../models/model',
+                                              function_features=extract_wt if wavelet else None,
+                                              necessary_redimension=necessary_redimension)
         else:
+            train_dataset, train_labels = train_set.to_array()
+            train_dataset_proc = train_dataset if function is None else function(train_dataset)
             model = training_CNN(train_dataset_proc, train_labels, scale, batch_size=batch_size, num_epochs=num_epochs,
                                  model_path='../models/model', necessary_redimension=necessary_redimension)
 
+        # Feature extraction moved inside the model: raw (and perturbed) trials are evaluated directly
+        if in_graph_features and function is not None:
+            model = with_preprocessing(model, [feature_layer(extract_wt)], test_dataset.shape[1:] + (1,))
+            function = None
+            test_dataset_proc = test_dataset
+
         # Network evaluation
         if necessary_redimension:
             test_dataset_proc = np.expand_dims(test_dataset_proc, 3)
@@ -89,11 +111,6 @@ if __name__ == "__main__":
         tot_accuracies.append(results[1])
 
         # Ablation application
-        if wavelet:
-            function = extract_wt
-        else:
-            function = None
-
         accuracies = ablation(test_dataset, test_labels, model, function, n_segments, necessary_redimension=necessary_redimension)
         zero_accuracies.append(list(accuracies[0]))
         interpolation_accuracies.append(list(accuracies[1]))
@@ -105,25 +122,19 @@ if __name__ == "__main__":
         channel_accuracies_permutation.append(list(accuracies[1]))
 
         # Division of the dataset according to unique labels
-        classes, indexes = np.unique(test_labels, return_inverse=True, axis=0)
+        classes = np.unique(test_labels, axis=0)
 
-        for j, c in enumerate(classes):
+        for c in classes:
 
             print("Considering labels {}".format(c))
 
-            # Build the dataset corresponding to each label, in case applying the feature extractor algorithm
-            data = np.array([test_dataset[i] for i in range(len(indexes)) if indexes[i] == j])
-
-            if wavelet:
-                x = extract_wt(data)
-            else:
-                x = data
-
-            lab = np.repeat([c], data.shape[0], axis=0)
+            # Build the dataset corresponding to each label: trials and features (already redimensioned) are the
+            # rows of the ones of the test set
+            class_mask = np.all(test_labels == c, axis=1)
+            data, lab = test_dataset[class_mask], test_labels[class_mask]
+            x = test_dataset_proc[class_mask]
 
             # Evaluate the model with the built dataset with ablation and permutation
-            if necessary_redimension:
-                x = np.expand_dims(x, 3)
             results = model.evaluate(x, lab, verbose=0)
 
             accuracies_ab = ablation(data, lab, model, function, n_segments, necessary_redimension=necessary_redimension)
@@ -145,6 +156,10 @@ if __name__ == "__main__":
                 right_accuracies_permutation.append(list(accuracies_pe[0]))
                 channel_right_accuracies_permutation.append(list(accuracies_pe[1]))
 
+        # Features of this split are not needed by the following iterations
+        print('\n\t Features cache: ', features_cache.stats())
+        features_cache.clear()
+
     # Save output in different files
     save(tot_accuracies, output_folder+"/tot_accuracies.csv")
     save(zero_accuracies, output_folder+"/zero_accuracies.csv")
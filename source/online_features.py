@@ -0,0 +1,188 @@
+import numpy as np
+import pywt
+import scipy.signal
+
+from functions_filter import bandpass_sos
+from functions_montage import montage_matrix
+
+
+class OnlineExtractor:
+    """
+    Feature extraction on a continuous signal, received a few samples at a time: every hop, the features of the last
+    window (re-referenced and normalized as the trials of load_dataset) are emitted. The samples are kept in a buffer
+    and the statistics of the window are updated only with the samples entering and leaving it, so that the cost of
+    each hop depends on the hop length and not on the window length
+
+    Features can be the approximation coefficients of the wavelet decomposition (as extract_wt, n.channels x
+    n.coefficients) or the log-variance of the CSP components of a filter bank (as FBCSP_V4, n.bands * 2 * n_w),
+    computed with causal filters since the future samples are not available
+    """
+
+    def __init__(self, n_channels, fs=250, window_seconds=4, hop_seconds=0.2, channel_elaboration='car',
+                 features='wavelet', wavelet='sym9', bands=None, csp_filters=None, n_w=2, filter_order=3):
+        """
+        :param n_channels: number of channels of the signal
+        :param fs: sampling frequency of the signal
+        :param window_seconds: length of the window of the features
+        :param hop_seconds: interval between two consecutive windows
+        :param channel_elaboration: montage used for the re-referencing of the channels or None
+        :param features: 'wavelet' or 'csp'
+        :param wavelet: wavelet used for the decomposition
+        :param bands: list of (low frequency, high frequency) pairs of the filter bank (only for features = 'csp')
+        :param csp_filters: list of the CSP spatial filters W of each band, as in FBCSP_V4.W_list_band (only for
+        features = 'csp')
+        :param n_w: number of first and last CSP components considered (as in FBCSP_V4)
+        :param filter_order: order of the filters of the filter bank
+        """
+
+        self.window = int(window_seconds * fs)
+        self.hop = int(hop_seconds * fs)
+        self.features = features
+
+        if features not in ['wavelet', 'csp']:
+            raise ValueError('Unknown features: {}'.format(features))
+        if self.window % 2 != 0 or self.hop % 2 != 0:
+            raise ValueError('Window and hop must have an even number of samples')
+
+        self.montage = None if channel_elaboration is None else montage_matrix(channel_elaboration, n_channels)
+        if self.montage is not None:
+            n_channels = self.montage.shape[0]
+
+        # Signal buffer: the window is always made by the last samples, the buffer is compacted when it is full
+
+        self.buffer = np.zeros((2 * self.window, n_channels))
+        self.length = 0
+        self.count = 0
+        self.squares = np.zeros(n_channels)
+
+        if features == 'wavelet':
+            self.wavelet = wavelet
+            self.filter_length = pywt.Wavelet(wavelet).dec_len
+            if self.filter_length % 2 != 0 or self.hop > self.window - self.filter_length:
+                raise ValueError('Wavelet filter length must be even and the hop shorter than the window minus it')
+            self.interior = None
+
+        else:
+            # Filters are copied since scipy requires them writable (the cached designs are read-only)
+
+            components = list(range(n_w)) + list(range(-n_w, 0))
+            self.soses = [np.array(bandpass_sos(filter_order, low, high, fs)) for low, high in bands]
+            self.states = [np.zeros((sos.shape[0], 2, n_channels)) for sos in self.soses]
+            self.csp_filters = np.stack([np.asarray(W)[components] for W in csp_filters])
+            self.filtered = np.zeros((len(self.soses), 2 * self.window, n_channels))
+            self.sums = np.zeros((len(self.soses), n_channels))
+            self.products = np.zeros((len(self.soses), n_channels, n_channels))
+
+    def push(self, samples):
+        """
+        :param samples: new samples of the signal (n.samples x n.channels)
+        :return: features of the windows completed by the new samples (n.windows x features shape)
+        """
+
+        samples = np.asarray(samples, dtype=float)
+        if self.montage is not None:
+            samples = samples @ self.montage.T
+
+        features = []
+        start = 0
+
+        while start < len(samples):
+            # Samples up to the end of the next window
+
+            if self.count < self.window:
+                target = self.window
+            else:
+                target = self.count + self.hop - (self.count - self.window) % self.hop
+
+            end = start + min(len(samples) - start, target - self.count)
+            self.append(samples[start:end])
+            start = end
+
+            if self.count >= self.window and (self.count - self.window) % self.hop == 0:
+                features.append(self.emit())
+
+        return np.array(features)
+
+    def append(self, samples):
+        # Add the samples to the buffer, updating the statistics of the window
+
+        n = len(samples)
+
+        if self.length + n > len(self.buffer):
+            self.compact()
+
+        if self.features == 'csp':
+            filtered = np.empty((len(self.soses), n, self.buffer.shape[1]))
+            for b, sos in enumerate(self.soses):
+                filtered[b], self.states[b] = scipy.signal.sosfilt(sos, samples, axis=0, zi=self.states[b])
+            self.filtered[:, self.length:self.length + n] = filtered
+
+        self.buffer[self.length:self.length + n] = samples
+
+        leaving = slice(max(0, self.length - self.window), max(0, self.length + n - self.window))
+        self.length += n
+        self.count += n
+
+        self.squares += np.sum(np.square(samples), axis=0) - np.sum(np.square(self.buffer[leaving]), axis=0)
+
+        if self.features == 'csp':
+            old = self.filtered[:, leaving]
+            self.sums += np.sum(filtered, axis=1) - np.sum(old, axis=1)
+            self.products += np.matmul(filtered.transpose(0, 2, 1), filtered) - np.matmul(old.transpose(0, 2, 1), old)
+
+    def compact(self):
+        # Move the current window at the start of the buffer and compute again its statistics (to avoid the
+        # accumulation of rounding errors)
+
+        window = slice(max(0, self.length - self.window), self.length)
+        n = window.stop - window.start
+
+        self.buffer[:n] = self.buffer[window]
+        self.squares = np.sum(np.square(self.buffer[:n]), axis=0)
+
+        if self.features == 'csp':
+            self.filtered[:, :n] = self.filtered[:, window]
+            self.sums = np.sum(self.filtered[:, :n], axis=1)
+            self.products = np.matmul(self.filtered[:, :n].transpose(0, 2, 1), self.filtered[:, :n])
+
+        self.length = n
+
+    def emit(self):
+        # Features of the current window
+
+        norm = np.sqrt(self.squares)
+        norm[norm == 0] = 1
+
+        if self.features == 'wavelet':
+            return self.wavelet_features() / norm[:, np.newaxis]
+
+        # Covariance of the filtered channels, scaled as the normalized signals, and variance of the CSP components
+
+        mean = self.sums / self.window
+        covariance = self.products / self.window - mean[:, :, np.newaxis] * mean[:, np.newaxis, :]
+        covariance /= norm[:, np.newaxis] * norm[np.newaxis, :]
+
+        variance = np.einsum('bkc,bcd,bkd->bk', self.csp_filters, covariance, self.csp_filters)
+
+        return np.log(variance).reshape(-1)
+
+    def wavelet_features(self):
+        # Approximation coefficients of the current window (n.channels x n.coefficients): the interior coefficients
+        # (not depending on the extension of the window) are shifted by half hop at each hop, only the new ones and the
+        # ones near the borders are computed
+
+        x = self.buffer[self.length - self.window:self.length]
+        border = (self.filter_length - 2) // 2
+        w, h, l = self.window, self.hop, self.filter_length
+
+        if self.interior is None:
+            ca, _ = pywt.dwt(x, self.wavelet, axis=0)
+            self.interior = ca[border:w // 2]
+        else:
+            new, _ = pywt.dwt(x[w - h - l + 2:], self.wavelet, axis=0)
+            self.interior = np.concatenate((self.interior[h // 2:], new[border:border + h // 2]))
+
+        left, _ = pywt.dwt(x[:l], self.wavelet, axis=0)
+        right, _ = pywt.dwt(x[w - l + 2:], self.wavelet, axis=0)
+
+        return np.concatenate((left[:border], self.interior, right[border:])).T
@@ -0,0 +1,98 @@
+import numpy as np
+
+
+class TrialIndex:
+    """
+    Columnar index of the trials of a dataset: for each trial it contains the subject, the run, the sample at which
+    the trial starts, the class (0 for left hand, 1 for right hand) and the artefact flag. Queries return the
+    positions of the selected trials, to be used directly for the indexing of the trials matrix
+    """
+
+    columns = {'subject': np.int16, 'run': np.int16, 'sample': np.int64, 'label': np.int8, 'artefact': np.bool_}
+
+    def __init__(self, subject, run, sample, label, artefact):
+        """
+        :param subject: index of the subject of each trial
+        :param run: run (starting from 1) of each trial
+        :param sample: sample at which each trial starts inside the signal of its subject
+        :param label: class of each trial (0 for left hand, 1 for right hand)
+        :param artefact: True for the trials labeled as artefacts
+        """
+
+        values = {'subject': subject, 'run': run, 'sample': sample, 'label': label, 'artefact': artefact}
+
+        for name, dtype in self.columns.items():
+            setattr(self, name, np.asarray(values[name], dtype=dtype))
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix=''):
+        """
+        :param arrays: dictionary with an array for each column (e.g. read from the trials cache)
+        :param prefix: prefix of the names of the columns inside the dictionary
+        :return: index built from the columns
+        """
+
+        return cls(*[arrays[prefix + name] for name in cls.columns])
+
+    def to_arrays(self, prefix=''):
+        """
+        :param prefix: prefix to be added to the names of the columns
+        :return: dictionary with an array for each column
+        """
+
+        return {prefix + name: getattr(self, name) for name in self.columns}
+
+    @classmethod
+    def concatenate(cls, indexes):
+        """
+        :param indexes: list of indexes (e.g. one for each subject)
+        :return: index of all the trials, in the same order
+        """
+
+        return cls(*[np.concatenate([getattr(index, name) for index in indexes]) for name in cls.columns])
+
+    def save(self, path):
+        np.savez(path, **self.to_arrays())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls.from_arrays(arrays)
+
+    def __len__(self):
+        return len(self.label)
+
+    def __getitem__(self, positions):
+        """
+        :param positions: positions of the trials to be kept (integer array, slice or boolean mask)
+        :return: index of the selected trials
+        """
+
+        return TrialIndex(*[getattr(self, name)[positions] for name in self.columns])
+
+    def select(self, subject=None, run=None, label=None, artefact=None):
+        """
+        Find the trials satisfying all the given conditions (each condition can be a value or a list of values)
+
+        :param subject: subjects to be selected
+        :param run: runs to be selected
+        :param label: classes to be selected (0 for left hand, 1 for right hand)
+        :param artefact: True to select only the trials labeled as artefacts, False to exclude them
+        :return: positions of the selected trials
+        """
+
+        selected = np.ones(len(self), dtype=bool)
+
+        for column, values in [(self.subject, subject), (self.run, run), (self.label, label),
+                               (self.artefact, artefact)]:
+            if values is not None:
+                selected &= np.isin(column, values)
+
+        return np.flatnonzero(selected)
+
+    def one_hot(self):
+        """
+        :return: one-hot labels of the trials ([1, 0] for left hand, [0, 1] for right hand)
+        """
+
+        return np.eye(2, dtype=np.int8)[self.label]
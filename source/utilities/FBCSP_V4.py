@@ -12,17 +12,19 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 import scipy.signal
-import scipy.linalg as la
 
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
 from sklearn.feature_selection import mutual_info_classif as MIBIF
 
+from functions_filter import filter_bank
+from functions_covariance import trial_covariances, composite_covariance, csp_filters
+
 
 #%%
 
 class FBCSP_V4():
     
-    def __init__(self, data_dict, fs, n_w = 2, n_features = 4, freqs_band = None, filter_order = 3, classifier = None, print_var = True):
+    def __init__(self, data_dict, fs, n_w = 2, n_features = 4, freqs_band = None, filter_order = 3, classifier = None, print_var = True, shrinkage = None, weighted_classes = False, n_jobs = 1):
         self.fs = fs
         self.trials_dict = data_dict
         self.n_w = n_w
@@ -31,6 +33,15 @@ class FBCSP_V4():
         self.n_trials_class_2 = data_dict[list(data_dict.keys())[1]].shape[0]
         self.print_var = print_var
         
+        # Covariance estimation: shrinkage of the trial covariances (None, 'ledoit_wolf', 'oas' or a fixed intensity) and
+        # weighting of the class covariances by their number of trials in the composite covariance
+        self.shrinkage = shrinkage
+        self.weighted_classes = weighted_classes
+        
+        # Number of threads filtering the frequency bands in parallel (see filter_bank). Each thread allocates the
+        # temporaries of the filtering of all the trials, so the memory used grows with the number of threads
+        self.n_jobs = n_jobs
+        
         # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
         #Filter data section
         
@@ -78,47 +89,39 @@ class FBCSP_V4():
 
         """
         
+        # Stack the trials of the classes and filter them in all the frequency bands with a single pass for each band
+        # (bands filtered in parallel if n_jobs > 1). Dimensions of the result: n_band x n_trial x n_channel x n_samples
+        keys = list(self.trials_dict.keys())
+        trials = np.concatenate([self.trials_dict[key] for key in keys], axis = 0)
+        self.filtered_bands = filter_bank(trials, self.normalizedBands(), 2, order = filter_order, n_jobs = self.n_jobs)
+        
+        # Position of the trials of each class inside the stacked trials
+        offsets = np.cumsum([0] + [self.trials_dict[key].shape[0] for key in keys])
+        
         # Cycle for the frequency bands
         for i in range(len(self.freqs) - 1):  
-            # Dict for selected band that will contain the various filtered signals
-            filt_trial_dict = {}
-            
-            # "Create" the band
-            band = [self.freqs[i], self.freqs[i+1]]
-            
-            # Cycle for the classes
-            for key in self.trials_dict.keys(): 
-                # Filter the signal in each class for the selected frequency band
-                filt_trial_dict[key] = self.bandFilterTrials(self.trials_dict[key], band[0], band[1], filter_order = filter_order)
+            # Dict for selected band that will contain the various filtered signals (views of the stacked ones)
+            filt_trial_dict = {key: self.filtered_bands[i, offsets[k]:offsets[k + 1]] for k, key in enumerate(keys)}
             
             # Save the filtered signal in the list
             self.filtered_band_signal_list.append(filt_trial_dict)
         
     
-    def bandFilterTrials(self, trials_matrix, low_f, high_f, filter_order = 3):
+    def normalizedBands(self):
         """
-        Applying a pass-band fitlering to the data. The filter implementation was done with scipy.signal
-    
-        Parameters
-        ----------
-        trials_matrix : numpy matrix
-            Numpy matrix with the various EEG trials. The dimensions of the matrix must be n_trial x n_channel x n_samples
-        fs : int/double
-            Frequency sampling.
-        low_f : int/double
-            Low band of the pass band filter.
-        high_f : int/double
-            High band of the pass band filter..
-        filter_order : int, optional
-            Order of the filter. The default is 3.
-    
+        Evaluate the bands of the filter bank (pairs of consecutive frequencies in self.freqs) in the [0, 1] range.
+
         Returns
         -------
-        filter_trails_matrix : numpy matrix
-             Numpy matrix with the various filtered EEG trials. The dimensions of the matrix must be n_trial x n_channel x n_samples.
-    
+        bands : list
+            List of (low bound, high bound) pairs, one for each band.
+
         """
         
+        return [self.normalizedBand(self.freqs[i], self.freqs[i+1]) for i in range(len(self.freqs) - 1)]
+    
+    
+    def normalizedBand(self, low_f, high_f):
         # Evaluate low buond and high bound in the [0, 1] range
         low_bound = low_f / (self.fs/2)
         high_bound = high_f / (self.fs/2)
@@ -129,22 +132,23 @@ class FBCSP_V4():
         if(low_bound > high_bound): low_bound, high_bound = high_bound, low_bound
         if(low_bound == high_bound): low_bound, high_bound = 0, 1
         
-        b, a = scipy.signal.butter(filter_order, [low_bound, high_bound], 'bandpass')
-          
-        return scipy.signal.filtfilt(b, a, trials_matrix)
-    
+        return low_bound, high_bound
+        
     
     def evaluateW(self):
         """
         Evaluate the spatial filter of the CSP algorithm for each filtered signal inside self.filtered_band_signal_list
         Results are saved inside self.W_list_band.    
+        
+        The filters are the generalized eigenvectors of the covariance of the first class against the composite 
+        covariance, computed for all the bands with a single batched call of the symmetric solver. 
+        The filters are real, sorted by decreasing eigenvalue and normalized as w' * R * w = 1.
         """
         
+        cov_1_list, R_list = [], []
+        
         for filt_trial_dict in self.filtered_band_signal_list:
             # Retrieve the key (class)
-            keys = list(filt_trial_dict.keys())
-            
-            
             keys = list(filt_trial_dict.keys())
             trials_1 = filt_trial_dict[keys[0]]
             trials_2 = filt_trial_dict[keys[1]]
@@ -152,26 +156,15 @@ class FBCSP_V4():
             # Evaluate covariance matrix for the two classes
             cov_1 = self.trialCovariance(trials_1)
             cov_2 = self.trialCovariance(trials_2)
-            R = cov_1 + cov_2
-            
-            # Evaluate whitening matrix
-            P = self.whitening(R)
-            
-            # The mean covariance matrices may now be transformed
-            cov_1_white = np.dot(P, np.dot(cov_1, np.transpose(P)))
-            cov_2_white = np.dot(P, np.dot(cov_2, np.transpose(P)))
+            R = composite_covariance([cov_1, cov_2], [trials_1.shape[0], trials_2.shape[0]] if self.weighted_classes else None)
             
-            # Since CSP requires the eigenvalues and eigenvector be sorted in descending order we find and sort the generalized eigenvalues and eigenvector
-            E, U = la.eig(cov_1_white, cov_2_white)
-            order = np.argsort(E)
-            order = order[::-1]
-            E = E[order]
-            U = U[:, order]
+            cov_1_list.append(cov_1)
+            R_list.append(R)
             
-            # The projection matrix (the spatial filter) may now be obtained
-            W = np.dot(np.transpose(U), P)
-            
-            self.W_list_band.append(W)
+        # Solve the generalized eigenproblem of all the bands (n_band x n_filter x n_channel)
+        W_bands, self.eigenvalues_band = csp_filters(np.array(cov_1_list), np.array(R_list))
+        
+        self.W_list_band = list(W_bands)
       
     
     def trialCovariance(self, trials):
@@ -190,60 +183,14 @@ class FBCSP_V4():
     
         """
         
-        n_trials, n_channels, n_samples = trials.shape
-        
-        covariance_matrix = np.zeros((n_trials, n_channels, n_channels))
-        
-        for i in range(trials.shape[0]):
-            trial = trials[i, :, :]
-            covariance_matrix[i, :, :] = np.cov(trial)
+        # Covariance of all the trials at once (with the optional shrinkage)
+        covariance_matrix = trial_covariances(trials, self.shrinkage)
             
         mean_cov = np.mean(covariance_matrix, 0)
             
         return mean_cov
     
     
-    def whitening(self, sigma, mode = 2):
-        """
-        Calculate the whitening matrix for the input matrix sigma
-    
-        Parameters
-        ----------
-        sigma : Numpy square matrix
-            Input matrix.
-        mode : int, optional
-            Select how to evaluate the whitening matrix. The default is 1.
-    
-        Returns
-        -------
-        x : Numpy square matrix
-            Whitening matrix.
-        """
-        [u, s, vh] = np.linalg.svd(sigma)
-        
-          
-        if(mode != 1 and mode != 2): mode == 1
-        
-        if(mode == 1):
-            # Whitening constant: prevents division by zero
-            epsilon = 1e-5
-            
-            # ZCA Whitening matrix: U * Lambda * U'
-            x = np.dot(u, np.dot(np.diag(1.0/np.sqrt(s + epsilon)), u.T))
-        else:
-            # eigenvalue decomposition of the covariance matrix
-            d, V = np.linalg.eigh(sigma)
-            fudge = 10E-18
-         
-            # A fudge factor can be used so that eigenvectors associated with small eigenvalues do not get overamplified.
-            D = np.diag(1. / np.sqrt(d+fudge))
-         
-            # whitening matrix
-            x = np.dot(np.dot(V, D), V.T)
-            
-        return x
-        
-    
     def spatialFilteringAndFeatureExtraction(self):
         # Cycle through frequency band and relative CSP filter
         for filt_trial_dict, W in zip(self.filtered_band_signal_list, self.W_list_band):
@@ -252,11 +199,8 @@ class FBCSP_V4():
             
             # Cycle through the classes
             for key in filt_trial_dict.keys():
-                # Applying spatial filter
-                tmp_trial = self.spatialFilteringW(filt_trial_dict[key], W)
-                
-                # Features evaluation
-                features_dict[key] = self.logVarEvaluation(tmp_trial)
+                # Spatial filter (only the components used) and features evaluation
+                features_dict[key] = self.logVarFeatures(filt_trial_dict[key], W)
             
             self.features_band_list.append(features_dict)
         
@@ -268,42 +212,47 @@ class FBCSP_V4():
         self.classifier_features = self.selectFeatures()
         
         
-    def spatialFilteringW(self, trials, W):
-        # Allocate memory for the spatial fitlered trials
-        trials_csp = np.zeros(trials.shape)
+    def componentsIndex(self):
+        # Rows of W used for the features: the first n_w and then the last n_w (from the -n_w-th to the last one)
+        idx = []
+        for i in range(self.n_w): idx.append(i)
+        for i in reversed(idx): idx.append(-(i + 1))
         
-        # Apply spatial fitler
-        for i in range(trials.shape[0]): trials_csp[i, :, :] = W.dot(trials[i, :, :])
-            
-        return trials_csp
+        return idx
     
     
-    def logVarEvaluation(self, trials):
+    def logVarFeatures(self, trials, W, components = None):
         """
-        Evaluate the log (logarithm) var (variance) of the trial matrix along the samples axis.
-        The sample axis is the axis number 2, counting axis as 0,1,2. 
+        Fused spatial filtering and log (logarithm) var (variance) evaluation along the samples axis. 
+        Only the rows of W actually used for the features are applied, with a single batched product for all the trials.
     
         Parameters
         ----------
         trials : numpy 3D-matrix
-            Trial matrix. The dimensions must be trials x channel x samples
+            Trial matrix filtered in the band of W. The dimensions must be trials x channel x samples
+        W : Numpy matrix
+            CSP spatial filter of the band.
+        components : list, optional
+            Positions of the features to evaluate (between 0 and 2 * n_w - 1, as the rows of W returned by componentsIndex). 
+            If None all the 2 * n_w features are evaluated.
     
         Returns
         -------
         features : Numpy 2D-matrix
-            Return the features matrix. DImension will be trials x channel
+            Return the features matrix. Dimension will be trials x number of components
     
         """
-        # Select the first and last n rows of the CSP filtered signal
-        idx = []
-        for i in range(self.n_w): idx.append(i)
-        for i in reversed(idx): idx.append(-(i + 1))
-        trials = trials[:, idx, :]    
         
-        features = np.var(trials, 2)
-        features = np.log(features)
+        idx = np.asarray(self.componentsIndex())
+        if(components is not None): idx = idx[components]
         
-        return features
+        # Each row of W is applied only once, also if it is used by more features (e.g. when 2 * n_w is larger than the number of channels)
+        rows, inverse = np.unique(idx % W.shape[0], return_inverse = True)
+        
+        trials_csp = np.matmul(W[rows], trials)
+        features = np.log(np.var(trials_csp, 2))
+        
+        return features[:, inverse.reshape(-1)]
     
     
     def featuresEvaluation(self, trials, W):
@@ -642,40 +591,163 @@ class FBCSP_V4():
         return y, y_prob
     
     
-    def extractFeatures(self, trials_matrix): 
-        # List for the features
-        features_list = []
+    def extractFeatures(self, trials_matrix, n_jobs = None): 
+        # Number of threads of the frequency filtering (None to use the one given to the constructor)
+        if(n_jobs == None): n_jobs = self.n_jobs
         
         # Input for the classifier
         features_input = np.zeros((trials_matrix.shape[0], len(self.classifier_features)))
         
-        # Frequency filtering, spatial filtering, features evaluation
-        for i in range(len(self.freqs) - 1):              
-            # "Create" the band
-            band = [self.freqs[i], self.freqs[i+1]]
+        # Bands with at least one selected feature (the other bands are not filtered at all)
+        selected_bands = sorted(set(feature_position[0] for feature_position in self.classifier_features))
+        bands = self.normalizedBands()
+        
+        # Frequency filtering of the selected bands
+        band_filter_trials_list = filter_bank(trials_matrix, [bands[band] for band in selected_bands], 2, n_jobs = n_jobs)
+        
+        # Spatial filtering and features evaluation, only for the selected features
+        for band_filter_trials_matrix, band in zip(band_filter_trials_list, selected_bands):
+            # Position of the features of the band in the input for the classifier and in the features of the band
+            columns = [i for i in range(len(self.classifier_features)) if self.classifier_features[i][0] == band]
+            components = [self.classifier_features[i][1] for i in columns]
             
-            # Retrieve spatial filter
-            W = self.W_list_band[i]
+            features_input[:, columns] = self.logVarFeatures(band_filter_trials_matrix, self.W_list_band[band], components)
             
-            # Frequency and spatial filter
-            band_filter_trials_matrix = self.bandFilterTrials(trials_matrix, band[0], band[1])
-            spatial_filter_trial = self.spatialFilteringW(band_filter_trials_matrix, W)
+        return features_input
+    
+    
+    def cacheTrials(self, trials_matrix, keep_signals = True, n_jobs = None):
+        """
+        Filter the trials (e.g. the test set) in the bands of the selected features and save the covariance of each trial in each band.
+        Since the filters act on each channel separately, the features of the trials with a perturbed channel can then be evaluated 
+        with an update of the covariances, without filtering the signals again (see channelAblationFeatures and channelPermutationFeatures).
+
+        Parameters
+        ----------
+        trials_matrix : Numpy 3D matrix
+            Input matrix of trials. The dimension MUST BE "n. trials x n. channels x n.samples".
+        keep_signals : Boolean, optional
+            If set to true also the filtered signals are saved (needed only by channelPermutationFeatures). The default is True.
+        n_jobs : int, optional
+            Number of threads filtering the bands in parallel. The default is None (the value given to the constructor).
+
+        """
+        
+        if(n_jobs == None): n_jobs = self.n_jobs
+        
+        # Frequency filtering of the bands with at least one selected feature
+        self.cached_bands = sorted(set(feature_position[0] for feature_position in self.classifier_features))
+        bands = self.normalizedBands()
+        filtered = filter_bank(trials_matrix, [bands[band] for band in self.cached_bands], 2, n_jobs = n_jobs)
+        
+        # Centered signals (the covariances are normalized by the number of samples, as the variance of logVarFeatures)
+        filtered -= np.mean(filtered, 3, keepdims = True)
+        n_samples = trials_matrix.shape[2]
+        
+        idx = np.asarray(self.componentsIndex())
+        self.cached_columns, self.cached_filters, self.cached_covariances, self.cached_products, self.cached_quadratic = [], [], [], [], []
+        self.cached_signals, self.cached_projections = [], []
+        
+        for band_filter_trials_matrix, band in zip(filtered, self.cached_bands):
+            # Position of the features of the band in the input for the classifier and rows of W of the features
+            columns = [i for i in range(len(self.classifier_features)) if self.classifier_features[i][0] == band]
+            W = self.W_list_band[band][idx[[self.classifier_features[i][1] for i in columns]]]
             
-            # Features evaluation
-            features = self.logVarEvaluation(spatial_filter_trial)
+            # Covariance of each trial (n_trial x n_channel x n_channel), C * w and w' * C * w for each feature
+            covariances = trial_covariances(band_filter_trials_matrix) * ((n_samples - 1) / n_samples)
+            products = np.matmul(covariances, W.T)
+            quadratic = np.einsum('fc,tcf->tf', W, products)
             
-            features_list.append(features)
-            # features_list.append(features[:, idx])
+            self.cached_columns.append(columns)
+            self.cached_filters.append(W)
+            self.cached_covariances.append(covariances)
+            self.cached_products.append(products)
+            self.cached_quadratic.append(quadratic)
             
-        # Features selection
-        for i in range(len(self.classifier_features)):
-            # Retrieve feature position
-            feature_position = self.classifier_features[i]
+            # Filtered signals and their spatial filtering (n_trial x n_features x n_samples)
+            if(keep_signals):
+                self.cached_signals.append(band_filter_trials_matrix)
+                self.cached_projections.append(np.matmul(W, band_filter_trials_matrix))
+    
+    
+    def cachedFeatures(self, quadratic_list):
+        # Input for the classifier from the variances (w' * C * w) of the selected features of each cached band
+        features_input = np.zeros((quadratic_list[0].shape[0], len(self.classifier_features)))
+        
+        for quadratic, columns in zip(quadratic_list, self.cached_columns): features_input[:, columns] = np.log(quadratic)
+        
+        return features_input
+    
+    
+    def ablatedQuadratic(self, b, channel):
+        # w' * C * w of the cached band b with the channel set to zero (row and column of C set to zero):
+        # w' * C * w - 2 * w_k * (C * w)_k + w_k^2 * C_kk
+        w_k = self.cached_filters[b][:, channel]
+        covariances = self.cached_covariances[b]
+        
+        return self.cached_quadratic[b] - 2 * w_k * self.cached_products[b][:, channel, :] + w_k ** 2 * covariances[:, channel, channel][:, np.newaxis]
+    
+    
+    def channelAblationFeatures(self, channel):
+        """
+        Evaluate the features of the cached trials (see cacheTrials) with the channel set to zero. 
+        The result is equal to extractFeatures applied to the perturbed trials.
+
+        Parameters
+        ----------
+        channel : int
+            Index of the channel set to zero.
+
+        Returns
+        -------
+        features_input : Numpy matrix
+            Features of the trials (n. trials x n. selected features).
+
+        """
+        
+        return self.cachedFeatures([self.ablatedQuadratic(b, channel) for b in range(len(self.cached_bands))])
+    
+    
+    def channelPermutationFeatures(self, channel, donors):
+        """
+        Evaluate the features of the cached trials (see cacheTrials, with keep_signals = True) with the channel of each trial 
+        substituted by the same channel of another trial. The result is equal to extractFeatures applied to the perturbed trials.
+
+        Parameters
+        ----------
+        channel : int
+            Index of the substituted channel.
+        donors : Numpy array
+            For each trial, the index of the trial from which the channel is taken.
+
+        Returns
+        -------
+        features_input : Numpy matrix
+            Features of the trials (n. trials x n. selected features).
+
+        """
+        
+        if(len(self.cached_signals) != len(self.cached_bands)): raise ValueError('Filtered signals not cached (keep_signals = False)')
+        
+        quadratic_list = []
+        
+        for b in range(len(self.cached_bands)):
+            w_k = self.cached_filters[b][:, channel]
+            signals = self.cached_signals[b]
+            n_samples = signals.shape[2]
             
-            # Retrieve feature from the evaluated features
-            features_input[:, i] = features_list[feature_position[0]][:, feature_position[1]]
+            # Channel of the trials and the one substituting it
+            x_k = signals[:, channel, :]
+            x_donor = x_k[donors]
             
-        return features_input
+            # Covariance between the substituted channel and the spatial filtering of the trial without the channel
+            cross = (np.einsum('tfs,ts->tf', self.cached_projections[b], x_donor) - w_k * np.einsum('ts,ts->t', x_k, x_donor)[:, np.newaxis]) / n_samples
+            
+            # w' * C * w of the trial without the channel, plus the contribution of the substituted channel
+            donor_variance = self.cached_covariances[b][donors, channel, channel][:, np.newaxis]
+            quadratic_list.append(self.ablatedQuadratic(b, channel) + 2 * w_k * cross + w_k ** 2 * donor_variance)
+            
+        return self.cachedFeatures(quadratic_list)
     
     
     def plotFeaturesSeparateTraining(self, width = 0.3, figsize = (15, 30)):
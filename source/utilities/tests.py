@@ -1,6 +1,8 @@
 import sys
 from source.functions_network import *
 from source.functions_dataset import *
+from source.functions_cache import FeatureCache, stored_features
+from source.benchmarks import check_fbcsp_channels
 from sklearn.model_selection import train_test_split
 import numpy as np
 import tensorflow as tf
@@ -15,18 +17,17 @@ if __name__ == "__main__":
 
     sys.stdout = open("../output/output - {} segments.txt".format(n_segments), "a")  # TO WRITE ALL OUTPUT IN A FILE
 
-    subjects = range(1, 10, 1)  # dataset composition
-    dataset, labels = None, None
-
-    for subject in subjects:
+    features_folder = '../../dataset/cache/features'   # features of the splits, reused by the following runs
 
-        if dataset is None:
-            dataset, labels = load_dataset(data_dir, subject)
+    # Features computed on the same data (e.g. by the ablation of the different segments) are computed only once
+    features_cache = FeatureCache()
+    extractFBCSP = features_cache.wrap(extractFBCSP)
+    extract_statistical_characteristics = features_cache.wrap(extract_statistical_characteristics)
+    extract_psd = features_cache.wrap(extract_psd)
 
-        else:
-            d, l = load_dataset(data_dir, subject)
-            dataset = np.concatenate((dataset, np.array(d)), axis=0)  # complete dataset
-            labels = np.concatenate((labels, np.array(l)), axis=0)  # Labels {1, 2}
+    subjects = range(1, 10, 1)  # dataset composition
+    dataset, labels = load_subjects(data_dir, subjects)
+    dataset_key, sources = dataset_cache_key(data_dir, subjects)
 
     # Common hyperparameters for the training
 
@@ -34,10 +35,17 @@ if __name__ == "__main__":
     num_epochs = 50
 
     labels = np.array(labels)
-    train_dataset, val_dataset, train_labels, val_labels = train_test_split(dataset, labels, train_size=0.7,
-                                                                            random_state=0)
-    val_dataset, test_dataset, val_labels, test_labels = train_test_split(val_dataset, val_labels, train_size=0.7,
-                                                                          random_state=0)
+    train_indexes, val_indexes = train_test_split(np.arange(len(dataset)), train_size=0.7, random_state=0)
+    val_indexes, test_indexes = train_test_split(val_indexes, train_size=0.7, random_state=0)
+
+    train_dataset, train_labels = dataset[train_indexes], labels[train_indexes]
+    val_dataset, val_labels = dataset[val_indexes], labels[val_indexes]
+    test_dataset, test_labels = dataset[test_indexes], labels[test_indexes]
+
+    def split_features(function_features, indexes, *args):
+        # Features of a split, read from the feature store if already computed
+        return stored_features(features_folder, function_features, dataset_key, indexes, lambda: dataset[indexes],
+                               *args, sources=sources)
 
     train_steps = int(np.ceil(train_dataset.shape[0] / batch_size))
     val_steps = int(np.ceil(val_dataset.shape[0] / batch_size))
@@ -65,9 +73,9 @@ if __name__ == "__main__":
 
     print("\nFBCSP DATASET:\n")
 
-    train_fbcsp = extractFBCSP(train_dataset, train_labels, n_features)
-    val_fbcsp = extractFBCSP(val_dataset, val_labels, n_features)
-    test_fbcsp = extractFBCSP(test_dataset, test_labels, n_features)
+    train_fbcsp = split_features(extractFBCSP, train_indexes, train_labels, n_features)
+    val_fbcsp = split_features(extractFBCSP, val_indexes, val_labels, n_features)
+    test_fbcsp = split_features(extractFBCSP, test_indexes, test_labels, n_features)
 
     if not os.path.exists('../../models/EEGNet_FBCSP.h5'):
         model = training_EEGNet(train_fbcsp, train_labels, val_fbcsp, val_labels, batch_size, num_epochs,
@@ -78,17 +86,22 @@ if __name__ == "__main__":
     results = model.evaluate(test_fbcsp, test_labels, verbose=0)
     print("\nTest loss, Test accuracy: ", results)
 
-    ablation(test_dataset, test_labels, model, extractFBCSP, n_segments, n_features=n_features)
+    # FBCSP trained once on the test set (as by extractFBCSP): the features of the channel perturbations are computed
+    # from its band covariances, without filtering and training again for each channel
+    fbcsp_model = fit_fbcsp(test_dataset, test_labels, n_features)
+    check_fbcsp_channels(fbcsp_model, test_dataset, channels=[0])
+
+    ablation(test_dataset, test_labels, model, extractFBCSP, n_segments, n_features=n_features, fbcsp=fbcsp_model)
     # ablation_label_depending(test_dataset, test_labels, model, extractFBCSP, n_segments, n_features=n_features)
-    permutation(test_dataset, test_labels, model, extractFBCSP, n_segments, n_features=n_features)
+    permutation(test_dataset, test_labels, model, extractFBCSP, n_segments, n_features=n_features, fbcsp=fbcsp_model)
 
     # USE OF EEGNET WITH SC
 
     print("\nSTATISTICAL CHARACTERISTICS DATASET:\n")
 
-    train_sc = extract_statistical_characteristics(train_dataset)
-    val_sc = extract_statistical_characteristics(val_dataset)
-    test_sc = extract_statistical_characteristics(test_dataset)
+    train_sc = split_features(extract_statistical_characteristics, train_indexes)
+    val_sc = split_features(extract_statistical_characteristics, val_indexes)
+    test_sc = split_features(extract_statistical_characteristics, test_indexes)
 
     if not os.path.exists('../../models/EEGNet_sc.h5'):
         model = training_EEGNet(train_sc, train_labels, val_sc, val_labels, batch_size, num_epochs,
@@ -108,9 +121,9 @@ if __name__ == "__main__":
 
     print("\nPSD DATASET:\n")
 
-    train_psd = extract_psd(train_dataset)
-    val_psd = extract_psd(val_dataset)
-    test_psd = extract_psd(test_dataset)
+    train_psd = split_features(extract_psd, train_indexes)
+    val_psd = split_features(extract_psd, val_indexes)
+    test_psd = split_features(extract_psd, test_indexes)
 
     if not os.path.exists('../../models/EEGNet_psd.h5'):
         model = training_EEGNet(train_psd, train_labels, val_psd, val_labels, batch_size, num_epochs,
@@ -126,4 +139,6 @@ if __name__ == "__main__":
 
     permutation(test_dataset, test_labels, model, extract_psd, n_segments)
 
+    print("\nFeatures cache: ", features_cache.stats())
+
     sys.stdout.close()